@@ -0,0 +1,94 @@
+import asyncio
+import random
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Optional
+
+import aiohttp
+
+# Ответы, после которых идемпотентный запрос имеет смысл повторить
+RETRY_STATUSES = {429, 502, 503, 504}
+
+
+class ApiError(Exception):
+    def __init__(self, status: int, body: str = ''):
+        super().__init__(f'HTTP {status}: {body[:200]}')
+        self.status = status
+        self.body = body
+
+
+class ApiClient:
+    """Клиент к нашему серверу (SERVER_URL): одна keep-alive сессия на процесс.
+
+    Пул соединений ограничен, число одновременных запросов — семафором (медленные
+    вызовы LLM не занимают потоки, нужные картинкам). Таймауты задаются по префиксу
+    пути; идемпотентные запросы повторяются с экспоненциальной задержкой и джиттером.
+    """
+
+    def __init__(self, base_url: str, *, pool: int = 16, concurrency: int = 8, retries: int = 3,
+                 backoff: float = 0.5, default_timeout: float = 60, timeouts: Optional[Dict[str, float]] = None):
+        self.base_url = base_url.rstrip('/')
+        self.pool = pool
+        self.retries = max(0, retries)
+        self.backoff = backoff
+        self.default_timeout = default_timeout
+        self.timeouts = timeouts or {}
+        self._slots = asyncio.Semaphore(max(1, concurrency))
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.pool, keepalive_timeout=30))
+        return self._session
+
+    def _timeout(self, path: str, timeout: Optional[float]) -> aiohttp.ClientTimeout:
+        if timeout is None:
+            # самый длинный совпавший префикс
+            matches = [p for p in self.timeouts if path.startswith(p)]
+            timeout = self.timeouts[max(matches, key=len)] if matches else self.default_timeout
+        return aiohttp.ClientTimeout(total=timeout)
+
+    @staticmethod
+    async def _read(r: aiohttp.ClientResponse):
+        if r.status >= 400:
+            raise ApiError(r.status, await r.text())
+        return await r.json(content_type=None)
+
+    async def request(self, method: str, path: str, *, json=None, timeout: Optional[float] = None, idempotent: Optional[bool] = None):
+        """Запрос с разбором JSON-ответа; ошибки HTTP — ApiError."""
+        if idempotent is None:
+            idempotent = method in ('GET', 'HEAD', 'PUT', 'DELETE')
+        attempts = 1 + (self.retries if idempotent else 0)
+        for attempt in range(attempts):
+            try:
+                async with self._slots:
+                    async with self._get_session().request(method, self.base_url + path, json=json,
+                                                           timeout=self._timeout(path, timeout)) as r:
+                        return await self._read(r)
+            except ApiError as e:
+                if e.status not in RETRY_STATUSES or attempt == attempts - 1:
+                    raise
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if attempt == attempts - 1:
+                    raise
+            # full jitter: пауза случайная в [0, backoff·2^attempt]
+            await asyncio.sleep(random.uniform(0, self.backoff * (2 ** attempt)))
+
+    async def get(self, path: str, **kw):
+        return await self.request('GET', path, **kw)
+
+    async def post(self, path: str, body: dict, **kw):
+        return await self.request('POST', path, json=body, **kw)
+
+    @asynccontextmanager
+    async def stream(self, method: str, path: str, *, json=None, timeout: Optional[float] = None) -> AsyncIterator[aiohttp.ClientResponse]:
+        """Потоковый ответ (например NDJSON); без повторов — часть данных уже могла быть прочитана."""
+        async with self._slots:
+            async with self._get_session().request(method, self.base_url + path, json=json,
+                                                   timeout=self._timeout(path, timeout)) as r:
+                if r.status >= 400:
+                    raise ApiError(r.status, await r.text())
+                yield r
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
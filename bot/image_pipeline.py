@@ -1,7 +1,12 @@
 from PIL import Image, ImageEnhance, ImageFilter, ImageOps
 import numpy as np
+import cv2
 import hashlib
+import io
+import math
 import random
+from collections import OrderedDict
+from typing import Optional
 
 PLACEMENTS = {
     'tl': 'tl', 'tr': 'tr', 'bl': 'bl', 'br': 'br', 'center': 'center'
@@ -42,38 +47,249 @@ def soft_augment(img: Image.Image, rng: random.Random) -> Image.Image:
     return im
 
 
-def apply_watermark(img: Image.Image, wm_img: Image.Image, placement: str = 'br', opacity: int = 70, margin: int = 24) -> Image.Image:
-    placement = PLACEMENTS.get(placement, 'br')
-    base = img.convert('RGBA')
-    logo = wm_img.convert('RGBA')
+# Ядро ImageFilter.SMOOTH (вырожденное изображение для ImageEnhance.Sharpness)
+_SMOOTH = np.array([[1, 1, 1], [1, 5, 1], [1, 1, 1]], dtype=np.float64) / 13.0
 
+
+def _gauss3(sigma: float) -> np.ndarray:
+    g = np.exp(-np.array([-1.0, 0.0, 1.0]) ** 2 / (2 * sigma * sigma))
+    g /= g.sum()
+    return np.outer(g, g)
+
+
+def soft_augment_fused(img: Image.Image, rng: random.Random) -> Image.Image:
+    """Быстрое ядро soft_augment: те же параметры из rng, но за три прохода.
+
+    crop + resize + rotate(expand) + resize сведены в один warpAffine,
+    яркость/контраст/шум — в одну таблицу LUT, резкость и блюр — в одну свёртку.
+    Результат визуально совпадает с soft_augment, но не побайтно.
+    """
+    im = ImageOps.exif_transpose(img).convert('RGB')
+    src = np.asarray(im)
+    h, w = src.shape[:2]
+    # параметры тянем из rng в том же порядке, что и soft_augment
+    perc = rng.uniform(0.01, 0.06)
+    dx, dy = int(w * perc), int(h * perc)
+    angle = rng.uniform(-1.5, 1.5)
+    b = 1.0 + rng.uniform(-0.05, 0.05)
+    c = 1.0 + rng.uniform(-0.05, 0.05)
+    s = 1.0 + rng.uniform(-0.05, 0.05)
+    noise = rng.normalvariate(0, 3)
+
+    # геометрия: выход -> (resize) -> повёрнутый холст -> (rotate) -> кроп -> исходник
+    t = math.radians(angle)
+    cos_t, sin_t = math.cos(t), math.sin(t)
+    xs = [cos_t * x + sin_t * y for x, y in ((-w / 2, -h / 2), (w / 2, -h / 2), (w / 2, h / 2), (-w / 2, h / 2))]
+    ys = [-sin_t * x + cos_t * y for x, y in ((-w / 2, -h / 2), (w / 2, -h / 2), (w / 2, h / 2), (-w / 2, h / 2))]
+    nw = math.ceil(max(xs)) - math.floor(min(xs))
+    nh = math.ceil(max(ys)) - math.floor(min(ys))
+    cw, ch = w - 2 * dx, h - 2 * dy
+    scale_e = np.diag([nw / w, nh / h])
+    rot = np.array([[cos_t, -sin_t], [sin_t, cos_t]])
+    scale_c = np.diag([cw / w, ch / h])
+    a = scale_c @ rot @ scale_e
+    off = scale_c @ (np.array([w / 2, h / 2]) - rot @ np.array([nw / 2, nh / 2]))
+    # непрерывные координаты -> центры пикселей OpenCV
+    off = a @ np.array([0.5, 0.5]) + off - 0.5
+    mat = np.hstack([a, off[:, None]])
+    # кроп — это view без копии; всё, что за его пределами, заливается белым, как у rotate(fillcolor)
+    arr = cv2.warpAffine(src[dy:h - dy, dx:w - dx], mat, (w, h), flags=cv2.INTER_CUBIC | cv2.WARP_INVERSE_MAP,
+                         borderMode=cv2.BORDER_CONSTANT, borderValue=(255, 255, 255))
+
+    # цвет: brightness -> contrast (относительно средней яркости) -> шум, одной таблицей
+    levels = np.arange(256, dtype=np.float64)
+    bright = np.clip(np.rint(levels * b), 0, 255)
+    sample = bright[arr[::4, ::4]]
+    mean = int(float((sample @ np.array([0.299, 0.587, 0.114])).mean()) + 0.5)
+    contrast = np.clip(np.rint(mean + c * (bright - mean)), 0, 255)
+    lut = np.clip(contrast + noise, 0, 255).astype(np.uint8)
+    arr = cv2.LUT(arr, lut)
+
+    # резкость (смесь с SMOOTH) и блюр radius=0.3 — одна свёртка 5×5
+    sharp = (1 - s) * _SMOOTH
+    sharp[1, 1] += s
+    kernel = cv2.filter2D(np.pad(sharp, 1), -1, _gauss3(0.3), borderType=cv2.BORDER_CONSTANT)
+    arr = cv2.filter2D(arr, -1, kernel.astype(np.float32), borderType=cv2.BORDER_REPLICATE)
+    return Image.fromarray(arr)
+
+
+AUGMENT_KERNELS = {
+    'pil': soft_augment,
+    'fused': soft_augment_fused,
+}
+
+
+def get_augment(name: str = 'pil'):
+    return AUGMENT_KERNELS.get(name, soft_augment)
+
+
+# Профили JPEG-кодировщика: legacy — побайтно как раньше (оптимизация Хаффмана, 4:2:2);
+# fast — libjpeg-turbo через cv2 без оптимизации; balanced — baseline без оптимизации;
+# small — прогрессивный с оптимизацией, меньше всего весит
+JPEG_PROFILES = {
+    'legacy': {'quality': 92, 'subsampling': 1, 'optimize': True},
+    'fast': {'quality': 90, 'subsampling': 2, 'cv2': True},
+    'balanced': {'quality': 88, 'subsampling': 2, 'optimize': False},
+    'small': {'quality': 82, 'subsampling': 2, 'optimize': True, 'progressive': True},
+}
+# Ниже этого качества режим целевого размера не опускается
+JPEG_MIN_QUALITY = 40
+_CV2_SUBSAMPLING = {1: 'IMWRITE_JPEG_SAMPLING_FACTOR_422', 2: 'IMWRITE_JPEG_SAMPLING_FACTOR_420'}
+
+
+def _encode_jpeg(img: Image.Image, profile: dict, quality: int) -> bytes:
+    if profile.get('cv2'):
+        arr = np.asarray(img.convert('RGB') if img.mode not in ('RGB', 'L') else img)
+        if arr.ndim == 3:
+            arr = cv2.cvtColor(arr, cv2.COLOR_RGB2BGR)
+        params = [cv2.IMWRITE_JPEG_QUALITY, quality, cv2.IMWRITE_JPEG_OPTIMIZE, 0]
+        factor = getattr(cv2, _CV2_SUBSAMPLING.get(profile.get('subsampling'), ''), None)
+        if factor is not None and hasattr(cv2, 'IMWRITE_JPEG_SAMPLING_FACTOR'):
+            params += [cv2.IMWRITE_JPEG_SAMPLING_FACTOR, factor]
+        ok, buf = cv2.imencode('.jpg', arr, params)
+        if not ok:
+            raise ValueError('cv2.imencode failed')
+        return buf.tobytes()
+    buf = io.BytesIO()
+    img.save(buf, format='JPEG', quality=quality, subsampling=profile['subsampling'],
+             optimize=profile.get('optimize', False), progressive=profile.get('progressive', False))
+    return buf.getvalue()
+
+
+def encode_jpeg(img: Image.Image, profile: str = 'legacy', target_bytes: Optional[int] = None) -> bytes:
+    """Кодирует в JPEG по профилю; с target_bytes — наибольшее качество, при котором файл не больше цели.
+
+    Качество ищется двоичным поиском в [JPEG_MIN_QUALITY, качество профиля] (не больше ~6 кодирований);
+    если цель недостижима, возвращается вариант с минимальным качеством.
+    """
+    prof = JPEG_PROFILES.get(profile, JPEG_PROFILES['legacy'])
+    data = _encode_jpeg(img, prof, prof['quality'])
+    if not target_bytes or len(data) <= target_bytes:
+        return data
+    lo, hi = JPEG_MIN_QUALITY, prof['quality'] - 1
+    best = None
+    while lo <= hi:
+        q = (lo + hi) // 2
+        candidate = _encode_jpeg(img, prof, q)
+        if len(candidate) <= target_bytes:
+            best, lo = candidate, q + 1
+        else:
+            hi = q - 1
+    return best if best is not None else _encode_jpeg(img, prof, JPEG_MIN_QUALITY)
+
+
+# Подготовленные логотипы: (sha256 логотипа, ширина логотипа, opacity) -> PreparedWatermark
+_PREPARED: 'OrderedDict[tuple, PreparedWatermark]' = OrderedDict()
+_PREPARED_MAX = 16
+
+
+class PreparedWatermark:
+    """Отмасштабированный логотип с уже применённой прозрачностью.
+
+    На каждое изображение остаётся только расчёт позиции и одно смешивание
+    в области логотипа.
+    """
+
+    def __init__(self, logo: Image.Image):
+        self.logo = logo
+
+    def position(self, size: tuple, placement: str = 'br', margin: int = 24) -> tuple:
+        placement = PLACEMENTS.get(placement, 'br')
+        bw, bh = size
+        lw, lh = self.logo.size
+        if placement == 'br':
+            return bw - lw - margin, bh - lh - margin
+        if placement == 'bl':
+            return margin, bh - lh - margin
+        if placement == 'tr':
+            return bw - lw - margin, margin
+        if placement == 'tl':
+            return margin, margin
+        return (bw - lw) // 2, (bh - lh) // 2
+
+    def apply(self, img: Image.Image, placement: str = 'br', margin: int = 24) -> Image.Image:
+        x, y = self.position(img.size, placement, margin)
+        lw, lh = self.logo.size
+        bw, bh = img.size
+        if x < 0 or y < 0 or x + lw > bw or y + lh > bh:
+            # логотип не помещается целиком — композитим всё изображение, как раньше
+            base = img.convert('RGBA')
+            base.alpha_composite(self.logo, (x, y))
+            return base.convert('RGB')
+        region = img.crop((x, y, x + lw, y + lh)).convert('RGBA')
+        region.alpha_composite(self.logo)
+        out = img.convert('RGB')
+        out.paste(region.convert('RGB'), (x, y))
+        return out
+
+
+def _logo_key(wm) -> str:
+    if isinstance(wm, str):
+        h = hashlib.sha256()
+        with open(wm, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                h.update(chunk)
+        return h.hexdigest()
+    return hashlib.sha256(f"{wm.mode}:{wm.size}".encode() + wm.tobytes()).hexdigest()
+
+
+def prepare_watermark(wm, base_width: int, opacity: int = 70, key: Optional[str] = None) -> PreparedWatermark:
+    """wm — Image или путь к логотипу; key — sha256 логотипа, если уже известен."""
+    target_w = int(base_width * 0.14)
+    ck = (key or _logo_key(wm), target_w, opacity)
+    prepared = _PREPARED.get(ck)
+    if prepared is not None:
+        _PREPARED.move_to_end(ck)
+        return prepared
+
+    if isinstance(wm, str):
+        with Image.open(wm) as im:
+            logo = im.convert('RGBA')
+    else:
+        logo = wm.convert('RGBA')
     # scale logo ~14% of width
-    bw, bh = base.size
-    target_w = int(bw * 0.14)
     ratio = target_w / logo.width
     logo = logo.resize((target_w, int(logo.height * ratio)), Image.Resampling.LANCZOS)
-
-    # apply opacity
+    # apply opacity (таблица вместо lambda на каждый пиксель)
     alpha = logo.split()[-1]
-    alpha = alpha.point(lambda p: int(p * (opacity / 100.0)))
+    alpha = alpha.point([int(p * (opacity / 100.0)) for p in range(256)])
     logo.putalpha(alpha)
 
-    x, y = 0, 0
-    if placement == 'br':
-      x = bw - logo.width - margin
-      y = bh - logo.height - margin
-    elif placement == 'bl':
-      x = margin
-      y = bh - logo.height - margin
-    elif placement == 'tr':
-      x = bw - logo.width - margin
-      y = margin
-    elif placement == 'tl':
-      x = margin
-      y = margin
-    elif placement == 'center':
-      x = (bw - logo.width) // 2
-      y = (bh - logo.height) // 2
-
-    base.alpha_composite(logo, (x, y))
-    return base.convert('RGB')
+    prepared = PreparedWatermark(logo)
+    _PREPARED[ck] = prepared
+    while len(_PREPARED) > _PREPARED_MAX:
+        _PREPARED.popitem(last=False)
+    return prepared
+
+
+def apply_watermark(img: Image.Image, wm_img, placement: str = 'br', opacity: int = 70, margin: int = 24, key: Optional[str] = None) -> Image.Image:
+    prepared = prepare_watermark(wm_img, img.size[0], opacity, key)
+    return prepared.apply(img, placement, margin)
+
+
+class WatermarkPreview:
+    """Сессия предпросмотра марки: уменьшенная копия фото и логотип готовятся один раз.
+
+    При смене позиции/прозрачности/отступа перекомпоновывается только логотип.
+    """
+
+    def __init__(self, src_path: Optional[str], logo_path: str, logo_key: Optional[str] = None, max_side: int = 1280):
+        if src_path:
+            with Image.open(src_path) as im:
+                full_w = im.width
+                # JPEG декодируется сразу в уменьшенном масштабе
+                im.draft('RGB', (max_side, max_side))
+                proxy = ImageOps.exif_transpose(im).convert('RGB')
+            proxy.thumbnail((max_side, max_side), Image.Resampling.BILINEAR)
+            self.scale = proxy.width / full_w
+        else:
+            proxy = Image.new('RGB', (800, 600), 'white')
+            self.scale = 1.0
+        self.proxy = proxy
+        self.logo_path = logo_path
+        self.logo_key = logo_key or _logo_key(logo_path)
+
+    def render(self, placement: str = 'br', opacity: int = 70, margin: int = 24) -> Image.Image:
+        prepared = prepare_watermark(self.logo_path, self.proxy.width, opacity, self.logo_key)
+        # отступ задан в пикселях полного кадра — переводим в масштаб превью
+        return prepared.apply(self.proxy, placement, int(round(margin * self.scale)))
@@ -0,0 +1,158 @@
+import asyncio
+import json
+import os
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+from utils.fileio import ensure_dir
+
+
+@dataclass
+class JobData:
+    user_id: int
+    job_id: str
+    base_description: str = ''
+    photos: List[Dict] = field(default_factory=list)  # {path, sha256, phash}
+    unique_photos: List[Dict] = field(default_factory=list)
+    N: int = 10
+    M: int = 5
+    archive_name: str = ''
+    watermark: Optional[Dict] = None  # {path, sha256, placement, opacity, margin}
+    status: str = 'Idle'
+    progress: int = 0
+    structured_facts: Optional[Dict] = None
+
+    def root(self):
+        return f'./workspace/{self.user_id}/{self.job_id}'
+
+    def save(self):
+        # атомарно: пишем во временный файл и переименовываем, job.json никогда не бывает оборванным
+        ensure_dir(self.root())
+        path = f'{self.root()}/job.json'
+        tmp = path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(self.__dict__, f, ensure_ascii=False, separators=(',', ':'))
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, user_id: int, job_id: str) -> Optional['JobData']:
+        path = f'./workspace/{user_id}/{job_id}/job.json'
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return cls(**json.load(f))
+        except (OSError, ValueError, TypeError):
+            return None
+
+
+@dataclass
+class UserSettings:
+    user_id: int
+    delivery: str = 'auto'  # auto — файлом, а слишком большой архив ссылкой; file; link
+
+    def path(self):
+        return f'./workspace/{self.user_id}/settings.json'
+
+    def save(self):
+        ensure_dir(os.path.dirname(self.path()))
+        tmp = self.path() + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(self.__dict__, f, ensure_ascii=False, separators=(',', ':'))
+        os.replace(tmp, self.path())
+
+    @classmethod
+    def load(cls, user_id: int) -> 'UserSettings':
+        try:
+            with open(cls(user_id).path(), 'r', encoding='utf-8') as f:
+                return cls(**json.load(f))
+        except (OSError, ValueError, TypeError):
+            return cls(user_id)
+
+
+class JobStore:
+    """Живые JobData в памяти; на диск — с задержкой (debounce) и явным flush на границах этапов.
+
+    В FSM хранится только job_id. В памяти держим не больше одной задачи на пользователя
+    плюс выполняющиеся (pin): остальные вытесняются и при обращении читаются с диска.
+    """
+
+    def __init__(self, delay: float = 2.0):
+        self.delay = delay
+        self._jobs: Dict[tuple, JobData] = {}
+        self._timers: Dict[tuple, asyncio.TimerHandle] = {}
+        self._pinned: set = set()
+
+    @staticmethod
+    def _key(user_id: int, job_id: str) -> tuple:
+        return int(user_id), str(job_id)
+
+    def create(self, user_id: int, job_id: str, **fields) -> JobData:
+        job = JobData(user_id=user_id, job_id=job_id, **fields)
+        self._evict_user(user_id)
+        self._jobs[self._key(user_id, job_id)] = job
+        self.flush(job)
+        return job
+
+    def get(self, user_id: int, job_id: Optional[str]) -> Optional[JobData]:
+        if not job_id:
+            return None
+        key = self._key(user_id, job_id)
+        job = self._jobs.get(key)
+        if job is None:
+            # после рестарта подхватываем job.json с диска
+            job = JobData.load(user_id, job_id)
+            if job is not None:
+                self._evict_user(user_id)
+                self._jobs[key] = job
+        return job
+
+    def save(self, job: JobData):
+        key = self._key(job.user_id, job.job_id)
+        if key in self._timers:
+            return
+        loop = asyncio.get_running_loop()
+        self._timers[key] = loop.call_later(self.delay, self._write, key)
+
+    def flush(self, job: JobData):
+        key = self._key(job.user_id, job.job_id)
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        job.save()
+
+    def flush_all(self):
+        for key in list(self._timers):
+            self._write(key)
+
+    def pin(self, job: JobData):
+        # выполняющаяся задача не вытесняется: run_job держит на неё ссылку
+        self._pinned.add(self._key(job.user_id, job.job_id))
+
+    def evict(self, job: JobData):
+        # сбросить на диск и забыть; следующий get прочитает job.json
+        key = self._key(job.user_id, job.job_id)
+        self._pinned.discard(key)
+        if key in self._jobs:
+            self.flush(job)
+            self._jobs.pop(key, None)
+
+    def _evict_user(self, user_id: int):
+        for key in [k for k in self._jobs if k[0] == int(user_id) and k not in self._pinned]:
+            self.evict(self._jobs[key])
+
+    def drop(self, job: JobData):
+        # без записи: используется при удалении рабочей папки
+        key = self._key(job.user_id, job.job_id)
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        self._pinned.discard(key)
+        self._jobs.pop(key, None)
+
+    def _write(self, key: tuple):
+        self._timers.pop(key, None)
+        job = self._jobs.get(key)
+        if job is not None:
+            try:
+                job.save()
+            except Exception as e:
+                print(f"Ошибка сохранения job.json: {e}")
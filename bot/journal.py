@@ -0,0 +1,119 @@
+import hashlib
+import json
+import os
+from typing import Dict, List, Optional, Tuple
+
+
+class JobJournal:
+    """Журнал выполнения задачи (append-only journal.jsonl) для продолжения после рестарта.
+
+    Первая строка — подпись параметров задачи; если параметры поменялись, журнал
+    начинается заново. Дальше: готовые тексты, готовые изображения (смещение в
+    archive.zip.part / размер / crc / sha256) и отметка о закрытии архива.
+    Каждая строка сбрасывается в ОС сразу (flush) — падение процесса её не теряет.
+    """
+
+    def __init__(self, root: str, signature: str):
+        self.path = f'{root}/journal.jsonl'
+        self.signature = signature
+        self.texts: Optional[List[str]] = None
+        self.images: Dict[Tuple[int, int], Dict] = {}
+        self.closed = False
+        self._f = None
+        self._torn = False
+        self._load()
+
+    @staticmethod
+    def make_signature(params: dict) -> str:
+        raw = json.dumps(params, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    @property
+    def fresh(self) -> bool:
+        return self.texts is None and not self.images and not self.closed
+
+    def _load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                lines = f.read().splitlines()
+        except OSError:
+            return
+        records = []
+        for line in lines:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                # оборванная последняя строка — всё, что до неё, валидно
+                self._torn = True
+                break
+        if not records or records[0].get('t') != 'start' or records[0].get('sig') != self.signature:
+            return
+        for rec in records[1:]:
+            t = rec.get('t')
+            if t == 'texts':
+                self.texts = rec['texts']
+            elif t == 'img':
+                self.images[(rec['v'], rec['m'])] = rec
+            elif t == 'closed':
+                self.closed = True
+
+    def open(self):
+        if self._f is not None:
+            return
+        if self.fresh:
+            self._rewrite([])
+        elif self._torn:
+            # дописывать после оборванной строки нельзя — переписываем журнал начисто
+            closed = self.closed
+            self.replace_images(self.images)
+            if closed:
+                self.record_closed()
+        else:
+            self._f = open(self.path, 'a', encoding='utf-8')
+
+    def _append(self, rec: dict):
+        self._f.write(json.dumps(rec, ensure_ascii=False, separators=(',', ':')) + '\n')
+        self._f.flush()
+
+    def _rewrite(self, records: List[dict]):
+        if self._f is not None:
+            self._f.close()
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            for rec in [{'t': 'start', 'sig': self.signature}] + records:
+                f.write(json.dumps(rec, ensure_ascii=False, separators=(',', ':')) + '\n')
+        os.replace(tmp, self.path)
+        self._f = open(self.path, 'a', encoding='utf-8')
+
+    def record_texts(self, texts: List[str]):
+        self.texts = list(texts)
+        self._append({'t': 'texts', 'texts': self.texts})
+
+    def record_image(self, v: int, m: int, **info):
+        rec = {'t': 'img', 'v': v, 'm': m, **info}
+        self.images[(v, m)] = rec
+        self._append(rec)
+
+    def record_closed(self):
+        self.closed = True
+        self._append({'t': 'closed'})
+
+    def replace_images(self, images: Dict[Tuple[int, int], Dict]):
+        """Переписывает журнал с новым набором изображений (после пересборки архива)."""
+        self.images = dict(images)
+        self.closed = False
+        records = ([{'t': 'texts', 'texts': self.texts}] if self.texts is not None else []) + list(self.images.values())
+        self._rewrite(records)
+        self._torn = False
+
+    def close(self):
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+
+    def remove(self):
+        self.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
@@ -0,0 +1,17 @@
+import hashlib
+import hmac
+import time
+from urllib.parse import quote
+
+# Подписанные ссылки на скачивание архива с нашего сервера (см. server/routes/download.js)
+
+
+def sign_download(rel_path: str, exp: int, secret: str) -> str:
+    return hmac.new(secret.encode('utf-8'), f'{rel_path}\n{exp}'.encode('utf-8'), hashlib.sha256).hexdigest()
+
+
+def download_url(public_url: str, secret: str, rel_path: str, ttl: int) -> str:
+    """Ссылка на файл rel_path (относительно рабочей папки бота), действительная ttl секунд."""
+    exp = int(time.time()) + ttl
+    sig = sign_download(rel_path, exp, secret)
+    return f"{public_url.rstrip('/')}/download/{quote(rel_path)}?exp={exp}&sig={sig}"
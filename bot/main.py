@@ -1,12 +1,14 @@
 import os
 from dotenv import load_dotenv
 import asyncio
+import glob
+import hashlib
 import json
 import time
-from dataclasses import dataclass, field
+from collections import OrderedDict
 from typing import List, Dict, Optional
 from aiogram import Bot, Dispatcher, Router, F
-from aiogram.exceptions import TelegramNetworkError
+from aiogram.exceptions import TelegramNetworkError, TelegramRetryAfter, TelegramBadRequest
 from aiogram.client.session.aiohttp import AiohttpSession
 from aiogram.filters import Command
 from aiogram.fsm.state import StatesGroup, State
@@ -15,12 +17,22 @@ from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKe
 from aiogram.enums import ParseMode
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from PIL import Image
-import requests
-
-from utils.fileio import ensure_dir, normalize_exif, sha256_file, delete_tree, save_preview
-from utils.phash import phash, hamming
-from image_pipeline import seeded_rng, soft_augment, apply_watermark
-from packer import pack_job
+import aiohttp
+
+from utils.fileio import ensure_dir, ingest_image, delete_tree, download_stream, sha256_file
+from utils.blobstore import BlobStore
+from utils.fingerprints import FingerprintStore
+from utils.phash_index import PhashIndex
+from utils.textuniq import UniqueTexts
+from image_pipeline import WatermarkPreview
+from packer import pack_job, StreamingArchive, read_stored_entry
+from render import RenderEngine, plan_batches
+from jobs import JobData, JobStore, UserSettings
+from journal import JobJournal
+from scheduler import JobScheduler, estimate_cost
+from progress import JobControl, PanelReporter, ThroughputMeter, format_eta
+from api import ApiClient
+from links import download_url
 
 # загрузка .env из корня проекта
 load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), '..', '.env'))
@@ -33,35 +45,109 @@ MAX_M = int(os.getenv('MAX_M', '20'))
 
 # Таймауты HTTP для бота (без прокси)
 HTTP_TIMEOUT = int(os.getenv('BOT_HTTP_TIMEOUT', '60'))  # секунды
-session = AiohttpSession(timeout=HTTP_TIMEOUT)
+# Пул соединений aiohttp бота и лимит параллельных скачиваний фото на пользователя
+BOT_HTTP_POOL = int(os.getenv('BOT_HTTP_POOL', '32'))
+MAX_DOWNLOADS_PER_USER = int(os.getenv('MAX_DOWNLOADS_PER_USER', '3'))
+# Ответ /texts/generate идёт потоком (NDJSON по чанкам); общий таймаут — на всю генерацию
+TEXT_GEN_TIMEOUT = int(os.getenv('TEXT_GEN_TIMEOUT', '180'))
+# Клиент к SERVER_URL: соединений в пуле, одновременных запросов, повторов идемпотентных вызовов
+API_POOL = int(os.getenv('API_POOL', '16'))
+API_CONCURRENCY = int(os.getenv('API_CONCURRENCY', '8'))
+API_RETRIES = int(os.getenv('API_RETRIES', '3'))
+
+# Пул процессов для рендера (0 — по числу ядер)
+RENDER_WORKERS = int(os.getenv('RENDER_WORKERS', '0')) or (os.cpu_count() or 1)
+RENDER_START_METHOD = os.getenv('RENDER_START_METHOD', 'spawn')
+# Кэш декодированных исходников на воркер (МБ) и размер пачки задач одного исходника
+FRAME_CACHE_MB = int(os.getenv('FRAME_CACHE_MB', '256'))
+RENDER_CHUNK = int(os.getenv('RENDER_CHUNK', '4'))
+# Ядро аугментации: pil — эталонное (побайтно как раньше), fused — быстрое на OpenCV
+AUGMENT_KERNEL = os.getenv('AUGMENT_KERNEL', 'pil')
+# Профиль JPEG: legacy (как раньше), fast (cv2/libjpeg-turbo), balanced, small (прогрессивный);
+# JPEG_TARGET_KB > 0 — подбирать качество так, чтобы фото было не больше стольких КБ
+JPEG_PROFILE = os.getenv('JPEG_PROFILE', 'legacy')
+JPEG_TARGET_KB = int(os.getenv('JPEG_TARGET_KB', '0'))
+# Отдельный небольшой пул для приёма фото, чтобы загрузки не ждали чужой рендер
+INGEST_WORKERS = int(os.getenv('INGEST_WORKERS', '2'))
+# Выдача архива: stream — zip пишется по мере рендера, folder — через папку out/ (как раньше)
+ARCHIVE_MODE = os.getenv('ARCHIVE_MODE', 'stream')
+# В режиме folder: паковать через сервер (/zip/create) или локально (по умолчанию; JPEG без пересжатия)
+ZIP_VIA_SERVER = os.getenv('ZIP_VIA_SERVER', '0') == '1'
+ZIP_WORKERS = int(os.getenv('ZIP_WORKERS', '4'))
+# Выдача архива ссылкой: внешний адрес сервера, секрет подписи, срок жизни ссылки;
+# в режиме auto архив крупнее лимита Bot API отдаётся ссылкой, а не файлом
+PUBLIC_URL = os.getenv('PUBLIC_URL', '')
+DOWNLOAD_SECRET = os.getenv('DOWNLOAD_SECRET', '')
+DOWNLOAD_TTL_HOURS = int(os.getenv('DOWNLOAD_TTL_HOURS', '24'))
+DELIVERY_FILE_LIMIT_MB = int(os.getenv('DELIVERY_FILE_LIMIT_MB', '50'))
+WORKSPACE_ROOT = os.path.abspath('./workspace')
+session = AiohttpSession(limit=BOT_HTTP_POOL, timeout=HTTP_TIMEOUT)
 bot = Bot(token=BOT_TOKEN, session=session)
 router = Router()
 dp = Dispatcher()
 dp.include_router(router)
+engine = RenderEngine(RENDER_WORKERS, RENDER_START_METHOD, FRAME_CACHE_MB * 1024 * 1024)
+ingest_engine = RenderEngine(INGEST_WORKERS, RENDER_START_METHOD, 0)
+
+# Планировщик задач: сколько задач одновременно, суммарная стоимость (Мп × изображений) и задач на пользователя
+SCHED_MAX_JOBS = int(os.getenv('SCHED_MAX_JOBS', '2'))
+SCHED_MAX_COST = float(os.getenv('SCHED_MAX_COST', '30000'))
+SCHED_PER_USER = int(os.getenv('SCHED_PER_USER', '1'))
+scheduler = JobScheduler(SCHED_MAX_JOBS, SCHED_MAX_COST, SCHED_PER_USER)
+
+
+# Панель прогресса правится не чаще раза в столько секунд (лимиты Telegram на правки)
+PANEL_MIN_INTERVAL = float(os.getenv('PANEL_MIN_INTERVAL', '3'))
+# Идущие задачи: job.root() -> отмена и панель прогресса
+_job_controls: Dict[str, JobControl] = {}
+
+
+# Живые задачи в памяти; job.json пишется с задержкой (секунды) и при смене этапа
+JOB_SAVE_DELAY = float(os.getenv('JOB_SAVE_DELAY', '2'))
+jobs = JobStore(JOB_SAVE_DELAY)
+
+
+async def current_job(state: FSMContext) -> Optional[JobData]:
+    # в FSM лежит только job_id, сам объект — в JobStore
+    data = await state.get_data()
+    return jobs.get(state.key.user_id, data.get('job_id'))
+
+
+# Отпечатки загруженных фото между задачами (SQLite)
+FINGERPRINT_DB = os.getenv('FINGERPRINT_DB', './workspace/fingerprints.sqlite')
+fingerprints = FingerprintStore(FINGERPRINT_DB)
+# Контентно-адресуемое хранилище исходников (сырые .bin и нормализованные .jpg)
+BLOB_STORE = os.getenv('BLOB_STORE', './workspace/blobs')
+blobs = BlobStore(BLOB_STORE)
+
+
+def release_photo_blobs(photos: List[Dict]):
+    # вызывать после удаления рабочей папки: блобы без ссылок удаляются
+    for item in photos:
+        blobs.release(item['sha256'], '.jpg')
+        if item.get('raw_sha256'):
+            blobs.release(item['raw_sha256'], '.bin')
 
+# Порог near-duplicate по pHash (расстояние Хэмминга)
+DEDUP_RADIUS = 10
+# Индексы уникальных фото по задачам: job.root() -> PhashIndex
+_photo_indexes: Dict[str, PhashIndex] = {}
 
-@dataclass
-class JobData:
-    user_id: int
-    job_id: str
-    base_description: str = ''
-    photos: List[Dict] = field(default_factory=list)  # {path, sha256, phash}
-    unique_photos: List[Dict] = field(default_factory=list)
-    N: int = 10
-    M: int = 5
-    archive_name: str = ''
-    watermark: Optional[Dict] = None  # {path, sha256, placement, opacity, margin}
-    status: str = 'Idle'
-    progress: int = 0
-    structured_facts: Optional[Dict] = None
 
-    def root(self):
-        return f'./workspace/{self.user_id}/{self.job_id}'
+def photo_index(job: 'JobData') -> PhashIndex:
+    idx = _photo_indexes.get(job.root())
+    if idx is None:
+        # после рестарта восстанавливаем индекс из job.json
+        idx = PhashIndex()
+        for item in job.unique_photos:
+            idx.add(item['phash'], item['path'])
+        _photo_indexes[job.root()] = idx
+    return idx
 
-    def save(self):
-        ensure_dir(self.root())
-        with open(f'{self.root()}/job.json', 'w', encoding='utf-8') as f:
-            json.dump(self.__dict__, f, ensure_ascii=False, indent=2)
+
+def drop_photo_index(job: 'JobData'):
+    # индекс нужен только на шаге приёма фото; после него (или отмены) держать его в памяти незачем
+    _photo_indexes.pop(job.root(), None)
 
 
 # ===== UI helpers: единый «панельный» месседж =====
@@ -96,6 +182,13 @@ async def edit_panel_text(ctx_msg: Message, state: FSMContext, *, text: str, rep
         return
     try:
         await bot.edit_message_text(chat_id=chat_id, message_id=panel_id, text=text, reply_markup=reply_markup)
+    except TelegramRetryAfter:
+        # флуд-лимит: пересоздание панели упрётся в тот же лимит, решает вызывающий
+        raise
+    except TelegramBadRequest as e:
+        if 'message is not modified' in str(e):
+            return
+        await send_panel_msg(ctx_msg, state, text=text, reply_markup=reply_markup)
     except Exception:
         # если редактирование не удалось (например, панель была медиа) — пересоздадим
         await send_panel_msg(ctx_msg, state, text=text, reply_markup=reply_markup)
@@ -112,13 +205,9 @@ class States(StatesGroup):
     Running = State()
 
 
-# ===== HTTP helpers (не блокируют event loop) =====
-async def _http_get(url: str, *, timeout: int = 120):
-    return await asyncio.to_thread(lambda: requests.get(url, timeout=timeout))
-
-
-async def _http_post(url: str, *, json_body: dict, timeout: int = 120):
-    return await asyncio.to_thread(lambda: requests.post(url, json=json_body, timeout=timeout))
+# ===== HTTP к нашему серверу (одна keep-alive сессия, не блокирует event loop) =====
+api = ApiClient(SERVER_URL, pool=API_POOL, concurrency=API_CONCURRENCY, retries=API_RETRIES, default_timeout=120,
+                timeouts={'/watermark': 30, '/texts/generate': TEXT_GEN_TIMEOUT, '/zip/create': 600})
 
 
 # ===== Telegram helpers =====
@@ -153,11 +242,14 @@ async def cmd_new(message: Message, state: FSMContext):
 
 @router.message(Command('cancel'))
 async def cmd_cancel(message: Message, state: FSMContext):
-    data = await state.get_data()
-    job_data = data.get('job')
-    if job_data:
+    job = await current_job(state)
+    if job:
+        drop_photo_index(job)
+        drop_preview_session(job)
         try:
-            delete_tree(JobData(**job_data).root())
+            jobs.drop(job)
+            delete_tree(job.root())
+            release_photo_blobs(job.photos)
         except Exception:
             pass
     await state.clear()
@@ -166,18 +258,53 @@ async def cmd_cancel(message: Message, state: FSMContext):
 
 @router.message(Command('status'))
 async def cmd_status(message: Message, state: FSMContext):
-    data = await state.get_data()
-    job_data = data.get('job')
-    if not job_data:
+    job = await current_job(state)
+    if not job:
         await message.answer('Активной задачи нет.')
     else:
-        job = JobData(**job_data)
         await message.answer(f"Статус: {job.status}, прогресс: {job.progress}%")
 
 
+DELIVERY_LABELS = {'auto': 'авто', 'file': 'файлом', 'link': 'ссылкой'}
+
+
+def links_enabled() -> bool:
+    return bool(PUBLIC_URL and DOWNLOAD_SECRET)
+
+
+def settings_text(st: UserSettings) -> str:
+    text = (f"Настройки по умолчанию: MAX_N, MAX_M, MAX_PHOTOS (env).\n"
+            f"Выдача архива: {DELIVERY_LABELS.get(st.delivery, st.delivery)} "
+            f"(авто — файлом, архив больше {DELIVERY_FILE_LIMIT_MB} МБ — ссылкой).")
+    if not links_enabled():
+        text += '\nСсылки на сервере не настроены (PUBLIC_URL, DOWNLOAD_SECRET) — архив отправляется файлом.'
+    return text
+
+
+def settings_kb(st: UserSettings):
+    return kb_simple([[(('• ' if st.delivery == k else '') + label.capitalize(), f'delivery:{k}') for k, label in DELIVERY_LABELS.items()]])
+
+
 @router.message(Command('settings'))
 async def cmd_settings(message: Message):
-    await message.answer('Настройки по умолчанию: MAX_N, MAX_M, MAX_PHOTOS (env). Переключатель выдачи zip ссылкой/файлом — в будущем.')
+    st = UserSettings.load(message.from_user.id)
+    await message.answer(settings_text(st), reply_markup=settings_kb(st))
+
+
+@router.callback_query(F.data.startswith('delivery:'))
+async def set_delivery(cb: CallbackQuery):
+    mode = cb.data.split(':', 1)[1]
+    if mode not in DELIVERY_LABELS:
+        await safe_cb_answer(cb)
+        return
+    st = UserSettings.load(cb.from_user.id)
+    st.delivery = mode
+    st.save()
+    await safe_cb_answer(cb, f'Выдача архива: {DELIVERY_LABELS[mode]}')
+    try:
+        await cb.message.edit_text(settings_text(st), reply_markup=settings_kb(st))
+    except TelegramBadRequest:
+        pass
 
 
 @router.callback_query(F.data == 'start')
@@ -200,10 +327,8 @@ async def next_to_photos(cb: CallbackQuery, state: FSMContext):
         return
     # init job
     job_id = str(int(time.time()))
-    jd = JobData(user_id=cb.from_user.id, job_id=job_id, base_description=base_description)
-    jd.archive_name = time.strftime('ads_%Y%m%d_%H%M')
-    jd.save()
-    await state.update_data(job=jd.__dict__)
+    jd = jobs.create(cb.from_user.id, job_id, base_description=base_description, archive_name=time.strftime('ads_%Y%m%d_%H%M'))
+    await state.update_data(job_id=jd.job_id)
 
     # переход на шаг ввода фактов
     await state.set_state(States.Facts)
@@ -276,12 +401,10 @@ def _parse_structured_facts(text: str) -> Dict:
 
 @router.message(States.Facts)
 async def facts_input(message: Message, state: FSMContext):
-    data = await state.get_data()
-    job = JobData(**data.get('job'))
+    job = await current_job(state)
     facts = _parse_structured_facts(message.text or '')
     job.structured_facts = facts if facts else None
-    job.save()
-    await state.update_data(job=job.__dict__, structured_facts=facts)
+    jobs.save(job)
     await state.set_state(States.CollectPhotos)
     await message.answer(
         'Шаг 3/6 — Приём фото. Пришлите 1…50 фото. Поддерживаются альбомы. Когда закончите — «Готово».',
@@ -296,11 +419,9 @@ async def facts_input(message: Message, state: FSMContext):
 
 @router.callback_query(States.Facts, F.data == 'facts:skip')
 async def facts_skip(cb: CallbackQuery, state: FSMContext):
-    data = await state.get_data()
-    job = JobData(**data.get('job'))
+    job = await current_job(state)
     job.structured_facts = None
-    job.save()
-    await state.update_data(job=job.__dict__)
+    jobs.save(job)
     await state.set_state(States.CollectPhotos)
     await cb.message.edit_text(
         'Шаг 3/6 — Приём фото. Пришлите 1…50 фото. Поддерживаются альбомы. Когда закончите — «Готово».',
@@ -313,80 +434,200 @@ async def facts_skip(cb: CallbackQuery, state: FSMContext):
     )
 
 
-async def _tg_file_download(message: Message, dest: str) -> Optional[str]:
+_download_slots: Dict[int, asyncio.Semaphore] = {}
+
+
+async def _tg_download(file_path: str, dest: str, user_id: int, *, timeout: int = 120) -> str:
+    """Скачивает файл Telegram потоком через aiohttp-сессию бота; возвращает sha256."""
+    slot = _download_slots.setdefault(user_id, asyncio.Semaphore(MAX_DOWNLOADS_PER_USER))
+    url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file_path}"
+    async with slot:
+        http = await bot.session.create_session()
+        return await download_stream(http, url, dest, timeout=timeout)
+
+
+async def _tg_file_download(message: Message, dest: str) -> Optional[tuple]:
     if message.photo:
         file = await bot.get_file(message.photo[-1].file_id)
     elif message.document and message.document.mime_type.startswith('image/'):
         file = await bot.get_file(message.document.file_id)
     else:
         return None
-    url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file.file_path}"
-    ensure_dir(os.path.dirname(dest))
-    r = await _http_get(url, timeout=120)
-    r.raise_for_status()
-    content = r.content
-    await asyncio.to_thread(lambda: open(dest, 'wb').write(content))
-    return dest
+    sha = await _tg_download(file.file_path, dest, message.from_user.id)
+    return dest, sha
+
+
+# Альбомы (media_group_id) копим короткое окно и принимаем одной пачкой
+MEDIA_GROUP_WINDOW = float(os.getenv('MEDIA_GROUP_WINDOW', '0.8'))  # секунды
+_album_buffers: Dict[tuple, List[Message]] = {}
+# Загрузка → изменение → запись job под одним замком на пользователя, чтобы не терять фото
+_user_locks: Dict[int, asyncio.Lock] = {}
+
+
+def _user_lock(user_id: int) -> asyncio.Lock:
+    return _user_locks.setdefault(user_id, asyncio.Lock())
+
+
+# Фото, которые уже скачиваются в задачу (job.root() -> сколько): лимит MAX_L проверяется до скачивания
+_pending_photos: Dict[str, int] = {}
+
+
+def _discard_photo(job: JobData, item: Dict):
+    # фото не вошло в задачу: убираем его файлы из source/ и освобождаем блобы
+    stamp = os.path.splitext(os.path.basename(item['path']))[0]
+    for path in (item['path'], f"{job.root()}/source/orig/{stamp}.bin"):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    release_photo_blobs([item])
+
+
+async def _ingest_photo(job: JobData, message: Message) -> Optional[tuple]:
+    """Скачивает и регистрирует одно фото; возвращает (item, seen_hint) или None."""
+    stamp = f"{int(time.time()*1000)}_{message.message_id}"
+    tmp_path = f"{job.root()}/source/_tmp_{stamp}.bin"
+    try:
+        downloaded = await _tg_file_download(message, tmp_path)
+    except Exception as e:
+        print(f"Ошибка скачивания фото (сообщение {message.message_id}): {e}")
+        downloaded = None
+    if not downloaded:
+        return None
+    saved, raw_sha = downloaded
+    norm_path = f"{job.root()}/source/{stamp}.jpg"
+    # сырые байты — в хранилище блобов, в задаче только жёсткая ссылка
+    blobs.put_file(saved, raw_sha, '.bin')
+    orig_link = blobs.link(raw_sha, f"{job.root()}/source/orig/{stamp}.bin", '.bin')
+    seen_hint = ''
+    fp = fingerprints.lookup(job.user_id, raw_sha)
+    if fp and blobs.has(fp['sha256'], '.jpg'):
+        # повторная загрузка: без нормализации и pHash, берём готовый блоб и отпечаток
+        sha, p, width, height = fp['sha256'], fp['phash'], fp['width'], fp['height']
+        if fp['job_id'] != job.job_id:
+            seen_hint = f"задаче {fp['job_id']}"
+    else:
+        # нормализация, sha256 и pHash за одно декодирование, вне event loop
+        tmp_norm = f"{job.root()}/source/_tmp_{stamp}.jpg"
+        try:
+            info = await ingest_engine.run(ingest_image, blobs.path(raw_sha, '.bin'), tmp_norm)
+        except Exception as e:
+            # не картинка (или битая): отклоняем только это фото и убираем его сырой блоб
+            print(f"Фото не распознано (сообщение {message.message_id}): {e}")
+            for p in (tmp_norm, orig_link):
+                if os.path.exists(p):
+                    os.remove(p)
+            blobs.release(raw_sha, '.bin')
+            return None
+        sha, p, width, height = info['sha256'], info['phash'], info['width'], info['height']
+        blobs.put_file(tmp_norm, sha, '.jpg')
+    blobs.link(sha, norm_path, '.jpg')
+    fingerprints.record(job.user_id, raw_sha, sha256=sha, phash=p, width=width, height=height, norm_path=blobs.path(sha, '.jpg'), job_id=job.job_id)
+    item = { 'path': norm_path, 'sha256': sha, 'raw_sha256': raw_sha, 'phash': int(p), 'width': width, 'height': height }
+    return item, seen_hint
+
+
+async def _ingest_batch(messages: List[Message], state: FSMContext):
+    first = messages[0]
+    job = await current_job(state)
+    root = job.root()
+    # места под фото резервируем до скачивания, с учётом параллельных альбомов:
+    # лишние фото не скачиваются вовсе
+    async with _user_lock(job.user_id):
+        free = MAX_L - len(job.photos) - _pending_photos.get(root, 0)
+        take = messages[:max(0, free)]
+        if take:
+            _pending_photos[root] = _pending_photos.get(root, 0) + len(take)
+    if not take:
+        await first.reply('Достигнут лимит фотографий. Нажмите «Готово».')
+        return
+    # скачивание и нормализация — параллельно, вне замка
+    # ошибка одного фото не должна ронять весь альбом: она считается как «не принято»
+    try:
+        results = await asyncio.gather(*[_ingest_photo(job, m) for m in take], return_exceptions=True)
+    finally:
+        _pending_photos[root] -= len(take)
+        if not _pending_photos[root]:
+            del _pending_photos[root]
+    for m, res in zip(take, results):
+        if isinstance(res, BaseException):
+            print(f"Ошибка приёма фото (сообщение {m.message_id}): {res!r}")
+    results = [None if isinstance(res, BaseException) else res for res in results]
+    failed = sum(1 for r in results if r is None) + len(messages) - len(take)
+
+    async with _user_lock(job.user_id):
+        # job — живой объект из JobStore: фото из параллельных апдейтов не теряются
+        idx = photo_index(job)
+        seen = set()
+        for res in results:
+            if res is None:
+                continue
+            item, hint = res
+            if len(job.photos) >= MAX_L:
+                # страховка: резерв выше не должен сюда пускать, но и без него фото не должно «повиснуть»
+                _discard_photo(job, item)
+                failed += 1
+                continue
+            job.photos.append(item)
+            if hint:
+                seen.add(hint)
+            # dedup: сравниваем только с уже принятыми уникальными фото через индекс
+            if not idx.query(item['phash'], DEDUP_RADIUS):
+                job.unique_photos.append(item)
+                idx.add(item['phash'], item['path'])
+        jobs.save(job)
+
+    hidden = len(job.photos) - len(job.unique_photos)
+    text = f"Получено: {len(job.photos)} (уникальных: {len(job.unique_photos)}). Скрыто дублей: {hidden}."
+    if failed:
+        text += f" Не принято: {failed}."
+    if seen:
+        text += f" Часть фото уже была в {', '.join(sorted(seen))}."
+    await first.reply(text)
 
 
 @router.message(States.CollectPhotos)
 async def on_photo(message: Message, state: FSMContext):
-    data = await state.get_data()
-    job = JobData(**data.get('job'))
     if message.photo is None and (message.document is None or not str(message.document.mime_type).startswith('image/')):
         await message.reply('Принимаю только фото. Видео/гиф отклоняются.')
         return
-    if len(job.photos) >= MAX_L:
-        await message.reply('Достигнут лимит фотографий. Нажмите «Готово».')
+    if not message.media_group_id:
+        await _ingest_batch([message], state)
         return
-
-    tmp_path = f"{job.root()}/source/_tmp_{int(time.time()*1000)}.bin"
-    saved = await _tg_file_download(message, tmp_path)
-    if not saved:
-        await message.reply('Не удалось скачать файл. Повторите.')
+    key = (message.chat.id, message.media_group_id)
+    buf = _album_buffers.get(key)
+    if buf is not None:
+        # первый апдейт альбома уже ждёт остальные — просто докладываем
+        buf.append(message)
         return
-    norm_path = f"{job.root()}/source/{int(time.time()*1000)}.jpg"
-    normalize_exif(saved, norm_path)
-    sha = sha256_file(norm_path)
-    with Image.open(norm_path) as im:
-        p = phash(im)
-    job.photos.append({ 'path': norm_path, 'sha256': sha, 'phash': int(p) })
-
-    # dedup
-    uniq = []
-    hidden = 0
-    for item in job.photos:
-        if not any(hamming(item['phash'], u['phash']) <= 10 for u in uniq):
-            uniq.append(item)
-        else:
-            hidden += 1
-    job.unique_photos = uniq
-
-    job.save()
-    await state.update_data(job=job.__dict__)
-    await message.reply(f"Получено: {len(job.photos)} (уникальных: {len(job.unique_photos)}). Скрыто дублей: {hidden}.")
+    _album_buffers[key] = [message]
+    await asyncio.sleep(MEDIA_GROUP_WINDOW)
+    batch = _album_buffers.pop(key)
+    await _ingest_batch(batch, state)
 
 
 @router.callback_query(States.CollectPhotos, F.data == 'clear_photos')
 async def clear_photos(cb: CallbackQuery, state: FSMContext):
-    data = await state.get_data()
-    job = JobData(**data.get('job'))
-    delete_tree(f"{job.root()}/source")
-    job.photos = []
-    job.unique_photos = []
-    job.save()
-    await state.update_data(job=job.__dict__)
+    async with _user_lock(cb.from_user.id):
+        job = await current_job(state)
+        delete_tree(f"{job.root()}/source")
+        release_photo_blobs(job.photos)
+        photo_index(job).clear()
+        job.photos = []
+        job.unique_photos = []
+        jobs.save(job)
     await cb.answer('Очищено.')
 
 
 @router.callback_query(States.CollectPhotos, F.data == 'done_photos')
 async def done_photos(cb: CallbackQuery, state: FSMContext):
-    data = await state.get_data()
-    job = JobData(**data.get('job'))
+    job = await current_job(state)
     K = len(job.unique_photos)
     if K < 1:
         await cb.answer('Нужно минимум 1 уникальное фото.', show_alert=True)
         return
+    drop_photo_index(job)
+    jobs.flush(job)
     await state.set_state(States.TuneParams)
     await cb.message.edit_text(
     f'Шаг 4/6 — Параметры. Описание {len(job.base_description)} симв., уникальных фото: {K}.',
@@ -400,13 +641,11 @@ async def done_photos(cb: CallbackQuery, state: FSMContext):
 
 @router.callback_query(States.TuneParams, F.data.startswith('n:'))
 async def choose_n(cb: CallbackQuery, state: FSMContext):
-    data = await state.get_data()
-    job = JobData(**data.get('job'))
+    job = await current_job(state)
     val = int(cb.data.split(':')[1])
     if 1 <= val <= MAX_N:
         job.N = val
-        job.save()
-        await state.update_data(job=job.__dict__)
+        jobs.save(job)
         await cb.answer(f'N={val}')
     else:
         await cb.answer('Недопустимое N')
@@ -414,15 +653,13 @@ async def choose_n(cb: CallbackQuery, state: FSMContext):
 
 @router.callback_query(States.TuneParams, F.data.startswith('m:'))
 async def choose_m(cb: CallbackQuery, state: FSMContext):
-    data = await state.get_data()
-    job = JobData(**data.get('job'))
+    job = await current_job(state)
     val = int(cb.data.split(':')[1])
     K = len(job.unique_photos)
     max_m = min(K, MAX_M)
     if 1 <= val <= max_m:
         job.M = val
-        job.save()
-        await state.update_data(job=job.__dict__)
+        jobs.save(job)
         await cb.answer(f'M={val}')
     else:
         await cb.answer(f'Недопустимое M (1..{max_m})')
@@ -430,12 +667,10 @@ async def choose_m(cb: CallbackQuery, state: FSMContext):
 
 @router.callback_query(States.TuneParams, F.data == 'wm')
 async def to_watermark(cb: CallbackQuery, state: FSMContext):
-    data = await state.get_data()
-    job = JobData(**data.get('job'))
+    job = await current_job(state)
     # fetch existing wm
     try:
-        r = await _http_get(f"{SERVER_URL}/watermark/{job.user_id}", timeout=10)
-        prev = r.json()
+        prev = await api.get(f"/watermark/{job.user_id}", timeout=10)
     except Exception:
         prev = None
     await state.set_state(States.Watermark)
@@ -450,13 +685,10 @@ async def to_watermark(cb: CallbackQuery, state: FSMContext):
 
 @router.callback_query(States.Watermark, F.data == 'wm:use_prev')
 async def wm_use_prev(cb: CallbackQuery, state: FSMContext):
-    data = await state.get_data()
-    job = JobData(**data.get('job'))
-    r = await _http_get(f"{SERVER_URL}/watermark/{job.user_id}", timeout=10)
-    prev = r.json()
+    job = await current_job(state)
+    prev = await api.get(f"/watermark/{job.user_id}", timeout=10)
     job.watermark = prev
-    job.save()
-    await state.update_data(job=job.__dict__)
+    jobs.save(job)
     await cb.answer('Используем сохранённую марку')
     # Показать предпросмотр и управление для подтверждения/тонкой настройки
     try:
@@ -470,11 +702,10 @@ async def wm_use_prev(cb: CallbackQuery, state: FSMContext):
 
 @router.callback_query(States.Watermark, F.data == 'wm:off')
 async def wm_off(cb: CallbackQuery, state: FSMContext):
-    data = await state.get_data()
-    job = JobData(**data.get('job'))
+    job = await current_job(state)
     job.watermark = None
-    job.save()
-    await state.update_data(job=job.__dict__)
+    jobs.save(job)
+    drop_preview_session(job)
     await cb.answer('Марка отключена')
     await state.set_state(States.Confirm)
     await send_panel_msg(cb.message, state,
@@ -528,20 +759,37 @@ def wm_controls_kb(job: JobData):
     return b.as_markup()
 
 
-async def render_wm_preview(job: JobData) -> str:
+# Сессии предпросмотра марки: job.root() -> (ключ источника, WatermarkPreview).
+# Держат декодированный кадр, поэтому живут только на шаге марки и не больше _PREVIEW_MAX штук
+_preview_sessions: 'OrderedDict[str, tuple]' = OrderedDict()
+_PREVIEW_MAX = 8
+
+
+def _preview_session(job: JobData) -> WatermarkPreview:
     # choose first unique photo for preview; fallback to white canvas
+    src_path = job.unique_photos[0]['path'] if job.unique_photos else None
+    key = (src_path, job.watermark['filePath'], job.watermark.get('sha256'))
+    cached = _preview_sessions.get(job.root())
+    if cached and cached[0] == key:
+        _preview_sessions.move_to_end(job.root())
+        return cached[1]
+    session = WatermarkPreview(src_path, job.watermark['filePath'], job.watermark.get('sha256'))
+    _preview_sessions[job.root()] = (key, session)
+    _preview_sessions.move_to_end(job.root())
+    while len(_preview_sessions) > _PREVIEW_MAX:
+        _preview_sessions.popitem(last=False)
+    return session
+
+
+def drop_preview_session(job: JobData):
+    _preview_sessions.pop(job.root(), None)
+
+
+async def render_wm_preview(job: JobData) -> str:
     preview_path = f"{job.root()}/preview/wm_preview.jpg"
     os.makedirs(os.path.dirname(preview_path), exist_ok=True)
-    src_path = job.unique_photos[0]['path'] if job.unique_photos else None
-    if src_path:
-        with Image.open(src_path) as src, Image.open(job.watermark['filePath']) as wm:
-            img = apply_watermark(src, wm, job.watermark.get('placement', 'br'), job.watermark.get('opacity', 70), job.watermark.get('margin', 24))
-            img.save(preview_path, format='JPEG', quality=85, subsampling=1, optimize=True)
-    else:
-        with Image.open(job.watermark['filePath']) as wm:
-            canvas = Image.new('RGB', (800, 600), 'white')
-            img = apply_watermark(canvas, wm, job.watermark.get('placement', 'br'), job.watermark.get('opacity', 70), job.watermark.get('margin', 24))
-            img.save(preview_path, format='JPEG', quality=85, subsampling=1, optimize=True)
+    img = _preview_session(job).render(job.watermark.get('placement', 'br'), job.watermark.get('opacity', 70), job.watermark.get('margin', 24))
+    img.save(preview_path, format='JPEG', quality=85)
     return preview_path
 
 
@@ -550,26 +798,15 @@ async def wm_upload(message: Message, state: FSMContext):
     if not message.document and not message.photo:
         await message.reply('Пришлите логотип как файл или фото.')
         return
-    data = await state.get_data()
-    job = JobData(**data.get('job'))
+    job = await current_job(state)
     tmp_path = f"{job.root()}/preview/wm_tmp.bin"
     if message.photo:
         file = await bot.get_file(message.photo[-1].file_id)
     else:
         file = await bot.get_file(message.document.file_id)
-    url = f"https://api.telegram.org/file/bot{os.getenv('BOT_TOKEN')}/{file.file_path}"
-    r = await _http_get(url, timeout=60)
-    r.raise_for_status()
-    ensure_dir(os.path.dirname(tmp_path))
-    await asyncio.to_thread(lambda: open(tmp_path, 'wb').write(r.content))
-
-    with Image.open(tmp_path) as im:
-        wm_preview = apply_watermark(Image.new('RGB', (800, 600), 'white'), im, placement='br', opacity=70, margin=24)
-    preview_path = f"{job.root()}/preview/wm_preview.jpg"
-    save_preview(wm_preview, preview_path)
+    sha = await _tg_download(file.file_path, tmp_path, message.from_user.id, timeout=60)
 
     # persist on server as user watermark
-    sha = sha256_file(tmp_path)
     storage_path = f"storage/watermarks/{job.user_id}/logo.png"
     os.makedirs(os.path.dirname(storage_path), exist_ok=True)
     Image.open(tmp_path).save(storage_path)
@@ -584,13 +821,13 @@ async def wm_upload(message: Message, state: FSMContext):
     }
     # сохраняем на сервере неблокирующим образом
     try:
-        await _http_post(f"{SERVER_URL}/watermark", json_body=payload, timeout=30)
+        # upsert по userId — повтор безопасен
+        await api.post("/watermark", payload, idempotent=True)
     except Exception:
         pass
 
     job.watermark = payload
-    job.save()
-    await state.update_data(job=job.__dict__)
+    jobs.save(job)
     try:
         preview = await render_wm_preview(job)
         await send_panel_msg(message, state, photo_path=preview,
@@ -602,50 +839,43 @@ async def wm_upload(message: Message, state: FSMContext):
 
 @router.callback_query(States.Watermark, F.data.startswith('wm_pos:'))
 async def wm_set_pos(cb: CallbackQuery, state: FSMContext):
-    data = await state.get_data()
-    job = JobData(**data.get('job'))
+    job = await current_job(state)
     pos = cb.data.split(':')[1]
     if not job.watermark:
         await cb.answer('Сначала загрузите логотип')
         return
     job.watermark['placement'] = pos
-    job.save()
-    await state.update_data(job=job.__dict__)
+    jobs.save(job)
     await cb.answer(f'Позиция: {pos}')
 
 
 @router.callback_query(States.Watermark, F.data.startswith('wm_opacity:'))
 async def wm_set_opacity(cb: CallbackQuery, state: FSMContext):
-    data = await state.get_data()
-    job = JobData(**data.get('job'))
+    job = await current_job(state)
     val = int(cb.data.split(':')[1])
     if not job.watermark:
         await cb.answer('Сначала загрузите логотип')
         return
     job.watermark['opacity'] = max(10, min(100, val))
-    job.save()
-    await state.update_data(job=job.__dict__)
+    jobs.save(job)
     await cb.answer(f'Opacity: {job.watermark["opacity"]}%')
 
 
 @router.callback_query(States.Watermark, F.data.startswith('wm_margin:'))
 async def wm_set_margin(cb: CallbackQuery, state: FSMContext):
-    data = await state.get_data()
-    job = JobData(**data.get('job'))
+    job = await current_job(state)
     val = int(cb.data.split(':')[1])
     if not job.watermark:
         await cb.answer('Сначала загрузите логотип')
         return
     job.watermark['margin'] = max(0, min(64, val))
-    job.save()
-    await state.update_data(job=job.__dict__)
+    jobs.save(job)
     await cb.answer(f'Margin: {job.watermark["margin"]}')
 
 
 @router.callback_query(States.Watermark, F.data == 'wm:preview')
 async def wm_preview(cb: CallbackQuery, state: FSMContext):
-    data = await state.get_data()
-    job = JobData(**data.get('job'))
+    job = await current_job(state)
     if not job.watermark:
         await cb.answer('Нет логотипа')
         return
@@ -661,8 +891,9 @@ async def wm_preview(cb: CallbackQuery, state: FSMContext):
 
 @router.callback_query(States.Watermark, F.data == 'wm:ok')
 async def wm_ok(cb: CallbackQuery, state: FSMContext):
-    data = await state.get_data()
-    job = JobData(**data.get('job'))
+    job = await current_job(state)
+    drop_preview_session(job)
+    jobs.flush(job)
     await state.set_state(States.Confirm)
     wm_state = 'выкл' if not job.watermark else f"вкл ({job.watermark.get('placement')}, {job.watermark.get('opacity')}%, m{job.watermark.get('margin')})"
     await send_panel_msg(cb.message, state,
@@ -678,97 +909,103 @@ async def confirm_back(cb: CallbackQuery, state: FSMContext):
                          reply_markup=kb_simple([[('Пропустить', 'wm:off')], [('◀ Назад', 'back'), ('✖ Отмена', 'cancel')]]))
 
 
-def simple_text_difference(text1: str, text2: str) -> float:
-    """Простая проверка различий между текстами по словам (возвращает долю различающихся слов)"""
-    words1 = set(text1.lower().split())
-    words2 = set(text2.lower().split())
-    
-    if not words1 and not words2:
-        return 0.0
-    if not words1 or not words2:
-        return 1.0
-        
-    intersection = words1.intersection(words2)
-    union = words1.union(words2)
-    
-    return 1.0 - (len(intersection) / len(union)) if union else 0.0
-
-
-def ensure_unique_texts(texts: List[str], base_description: str, min_difference: float = 0.3) -> List[str]:
-    """Обеспечивает уникальность каждого текста (минимум min_difference различий)"""
-    if not texts:
-        return [base_description]
-    
-    unique_texts = []
-    used_texts = set()
-    
-    for i, text in enumerate(texts):
-        # Проверяем, что текст достаточно отличается от уже использованных
-        is_unique = True
-        text_clean = text.strip()
-        
-        # Проверяем против всех уже добавленных текстов
-        for existing in unique_texts:
-            difference = simple_text_difference(text_clean, existing)
-            if difference < min_difference:
-                is_unique = False
-                break
-        
-        if is_unique and text_clean and text_clean not in used_texts:
-            unique_texts.append(text_clean)
-            used_texts.add(text_clean)
-        else:
-            # Если текст недостаточно уникален, модифицируем его
-            modified_text = f"{text_clean} [Объявление №{i+1}]"
-            unique_texts.append(modified_text)
-            used_texts.add(modified_text)
-    
-    return unique_texts
+# Порог уникальности описаний (доля различающихся шинглов) и размер шингла в словах
+TEXT_MIN_DIFFERENCE = float(os.getenv('TEXT_MIN_DIFFERENCE', '0.3'))
+TEXT_SHINGLE = int(os.getenv('TEXT_SHINGLE', '1'))
 
 
-async def generate_texts(base_facts: dict, base_description: str, n: int, style_hints: str = 'нейтрально, без воды') -> List[str]:
-    """Генерация уникальных текстов для каждого объявления"""
+async def _read_variants(r: aiohttp.ClientResponse, variants: List[str], on_variants=None):
+    if 'ndjson' in r.headers.get('Content-Type', ''):
+        async for line in r.content:
+            line = line.strip()
+            if not line:
+                continue
+            fresh = [str(x) for x in (json.loads(line).get('variants') or [])]
+            variants.extend(fresh)
+            if fresh and on_variants is not None:
+                await on_variants(fresh)
+        return
+    data = await r.json(content_type=None)
+    if isinstance(data, list):
+        variants.extend(str(x) for x in data)
+    elif isinstance(data, dict):
+        # сервер теперь возвращает { ok: true, variants: [...] }
+        raw = data.get('variants') or data.get('value') or data.get('texts') or data.get('data')
+        if isinstance(raw, list):
+            variants.extend(str(x) for x in raw)
+    if variants and on_variants is not None:
+        await on_variants(list(variants))
+
+
+async def generate_texts(base_facts: dict, base_description: str, n: int, style_hints: str = 'нейтрально, без воды', on_variants=None) -> List[str]:
+    """Запрашивает у сервера варианты текстов; возвращает то, что пришло (может быть меньше n).
+
+    on_variants(fresh) получает сырые варианты по мере прихода чанков с сервера.
+    Уникальность и добивка до n — на стороне вызывающего (см. _text_stage).
+    """
     body = {
         'baseFacts': base_facts,
         'baseDescription': base_description,
         'n': n,
-        'styleHints': style_hints
+        'styleHints': style_hints,
+        'stream': True
     }
+    variants: List[str] = []
     try:
-        r = await _http_post(f"{SERVER_URL}/texts/generate", json_body=body, timeout=180)
-        data = r.json()
-        variants: List[str] = []
-        if isinstance(data, list):
-            variants = [str(x) for x in data]
-        elif isinstance(data, dict):
-            # сервер теперь возвращает { ok: true, variants: [...] }
-            raw = data.get('variants') or data.get('value') or data.get('texts') or data.get('data')
-            if isinstance(raw, list):
-                variants = [str(x) for x in raw]
-        
-        # Обеспечиваем уникальность полученных текстов
-        if variants:
-            unique_variants = ensure_unique_texts(variants, base_description, min_difference=0.3)
-        else:
-            unique_variants = []
-        
-        # ensure N и fallback с уникальными модификациями
-        while len(unique_variants) < n:
-            fallback_text = f"{base_description} [Вариант {len(unique_variants) + 1}]"
-            unique_variants.append(fallback_text)
-        
-        # Обрезаем до нужного количества и финальная проверка уникальности
-        final_texts = unique_variants[:n]
-        final_unique = ensure_unique_texts(final_texts, base_description, min_difference=0.2)
-        
-        return final_unique[:n]
+        async with api.stream('POST', '/texts/generate', json=body) as r:
+            await _read_variants(r, variants, on_variants)
     except Exception as e:
-        # Fallback: создаем уникальные вариации базового описания
+        # то, что успело прийти до обрыва, используем; недостающее добьётся fallback-текстами
         print(f"Ошибка генерации текстов: {e}")
-        fallback_texts = []
-        for i in range(n):
-            fallback_texts.append(f"{base_description} [Вариант {i+1}]")
-        return fallback_texts
+    return variants
+
+
+async def _text_stage(job: JobData, journal: JobJournal, on_text) -> List[str]:
+    """Этап текстов: берёт готовые из журнала или генерирует; каждый текст отдаёт в on_text(v, text)."""
+    emitted: List[str] = []
+    if journal.texts is not None:
+        texts = journal.texts
+        print(f"Тексты взяты из журнала задачи: {len(texts)}")
+    else:
+        # Используем введённое пользователем описание как исходные факты (source)
+        base_facts = {'source': job.base_description}
+        if getattr(job, 'structured_facts', None):
+            base_facts['structured'] = job.structured_facts
+
+        # Один проход уникальности по мере прихода чанков: решение по тексту v зависит только
+        # от предыдущих, поэтому описание можно писать сразу
+        uniq = UniqueTexts(TEXT_MIN_DIFFERENCE, TEXT_SHINGLE)
+
+        async def accept(fresh: List[str]):
+            for text in fresh:
+                if len(uniq.texts) >= job.N:
+                    return
+                emitted.append(uniq.add(text))
+                await on_text(len(emitted) - 1, emitted[-1])
+
+        print(f"Запрос генерации {job.N} уникальных текстов...")
+        received = await generate_texts(base_facts, job.base_description, job.N, on_variants=accept)
+        print(f"Получено {len(received)} текстов")
+
+        # ensure N и fallback с уникальными модификациями
+        while len(emitted) < job.N:
+            await accept([f"{job.base_description} [Вариант {len(emitted) + 1}]"])
+        texts = emitted
+        journal.record_texts(texts)
+
+        # Сохраним на диск для диагностики
+        try:
+            ensure_dir(job.root())
+            with open(f"{job.root()}/generated_texts.json", 'w', encoding='utf-8') as f:
+                json.dump(texts, f, ensure_ascii=False, indent=2)
+            print(f"Тексты сохранены: {len(texts)} уникальных вариантов")
+        except Exception as e:
+            print(f"Ошибка сохранения текстов: {e}")
+
+    for v in range(len(emitted), job.N):
+        # УНИКАЛЬНЫЙ текст для каждого объявления
+        await on_text(v, texts[v] if v < len(texts) else f"{job.base_description} [Объявление №{v+1}]")
+    return texts
 
 
 def progress_bar(p: int) -> str:
@@ -776,115 +1013,251 @@ def progress_bar(p: int) -> str:
     return '▰' * blocks + '▱' * (10 - blocks) + f' {p}%'
 
 
+# Статусы идущей задачи: если бот перезапустился в одном из них, задачу можно продолжить
+RUNNING_STATUSES = {'Running', 'Генерация текстов', 'Аугментация изображений', 'Сборка архива'}
+
+
+def job_journal(job: JobData) -> JobJournal:
+    # подпись — всё, от чего зависит результат; изменили параметры — журнал начинается заново
+    params = {
+        'N': job.N,
+        'M': job.M,
+        'photos': [p.get('sha256') or p['path'] for p in job.unique_photos],
+        'description': job.base_description,
+        'facts': job.structured_facts,
+        'archive': job.archive_name,
+        'watermark': ({k: job.watermark.get(k) for k in ('sha256', 'placement', 'opacity', 'margin')} if job.watermark else None),
+        'kernel': AUGMENT_KERNEL,
+        'jpeg': [JPEG_PROFILE, JPEG_TARGET_KB],
+        'mode': ARCHIVE_MODE,
+    }
+    return JobJournal(job.root(), JobJournal.make_signature(params))
+
+
+def _photo_name(v: int, m: int) -> str:
+    return f"объявление {v+1:02d}/фото/photo_{m+1:02d}.jpg"
+
+
+def _archive_put(archive: StreamingArchive, v: int, m: int, data: bytes) -> dict:
+    zinfo = archive.add(_photo_name(v, m), data)
+    # данные должны дойти до ОС раньше записи в журнал
+    archive.flush()
+    return {'off': zinfo.header_offset, 'size': zinfo.file_size, 'crc': zinfo.CRC, 'sha': hashlib.sha256(data).hexdigest()}
+
+
+def _restore_archive(archive: StreamingArchive, prev_path: str, images: Dict[tuple, Dict]) -> Dict[tuple, Dict]:
+    # переносим уже готовые JPEG из прерванного .part в новый архив; битые (CRC) будут отрендерены заново
+    restored = {}
+    with open(prev_path, 'rb') as f:
+        for (v, m), rec in sorted(images.items()):
+            data = read_stored_entry(f, rec['off'], rec['size'], rec['crc'])
+            if data is None:
+                continue
+            zinfo = archive.add(_photo_name(v, m), data)
+            restored[(v, m)] = {**rec, 'off': zinfo.header_offset}
+    archive.flush()
+    return restored
+
+
+async def _send_result(cb: CallbackQuery, state: FSMContext, job: JobData, archive_path: str):
+    job.status = 'Готово'
+    job.progress = 100
+    jobs.flush(job)
+    drop_photo_index(job)
+    try:
+        await edit_panel_text(cb.message, state, text='Готово! ' + progress_bar(100), reply_markup=None)
+    except TelegramRetryAfter:
+        pass
+    # Заменим панель финальным сообщением с архивом (файлом или ссылкой — по настройке пользователя)
+    await _delete_prev_panel(state, cb.message.chat.id)
+    summary = f"Готово! Сгенерировано: {job.N} × {job.M} = {job.N*job.M} изображений. Архив: {os.path.basename(archive_path)}"
+    done_kb = kb_simple([[('🔁 Ещё один пакет', 'start')], [('🗑 Удалить временные файлы', 'cleanup')]])
+    size = os.path.getsize(archive_path)
+    delivery = UserSettings.load(job.user_id).delivery
+    as_link = links_enabled() and (delivery == 'link' or (delivery == 'auto' and size > DELIVERY_FILE_LIMIT_MB * 1024 * 1024))
+    if as_link:
+        rel_path = os.path.relpath(archive_path, WORKSPACE_ROOT).replace(os.sep, '/')
+        url = download_url(PUBLIC_URL, DOWNLOAD_SECRET, rel_path, DOWNLOAD_TTL_HOURS * 3600)
+        doc_msg = await cb.message.answer(
+            f"{summary} ({size / 1024 / 1024:.1f} МБ)\nСкачать (ссылка действует {DOWNLOAD_TTL_HOURS} ч, загрузку можно докачать):\n{url}",
+            reply_markup=done_kb
+        )
+    else:
+        doc_msg = await cb.message.answer_document(FSInputFile(archive_path), caption=summary, reply_markup=done_kb)
+    await state.update_data(panel_msg_id=doc_msg.message_id)
+    await state.set_state(States.Idle)
+    # исходники задаче больше не нужны: убираем её ссылки, блобы без других ссылок удаляются
+    delete_tree(f"{job.root()}/source")
+    release_photo_blobs(job.photos)
+
+
 @router.callback_query(States.Confirm, F.data == 'confirm')
 async def run_job(cb: CallbackQuery, state: FSMContext):
-    data = await state.get_data()
-    job = JobData(**data.get('job'))
+    job = await current_job(state)
 
     K = len(job.unique_photos)
     if job.N < 1 or job.N > MAX_N or job.M < 1 or job.M > min(K, MAX_M):
         await cb.answer('Проверьте N/M.', show_alert=True)
         return
+    if scheduler.is_active(job.root()):
+        await safe_cb_answer(cb, 'Задача уже в очереди')
+        return
 
     await state.set_state(States.Running)
     job.status = 'Running'
     job.progress = 0
-    job.save()
+    jobs.pin(job)
+    jobs.flush(job)
     # Сброс старой панели и старт единого прогресс-сообщения
     await _delete_prev_panel(state, cb.message.chat.id)
     await send_panel_msg(cb.message, state, text='Старт задачи… ' + progress_bar(0), reply_markup=kb_simple([[('✖ Остановить', 'stop')]]))
 
-    stop_flag_path = f"{job.root()}/.stop"
+    stop_kb = kb_simple([[('✖ Остановить', 'stop')]])
+    # отмена видна воркерам пула; правки панели идут через один отправитель с ограничением частоты
+    control = JobControl(engine.cancel_token(), PanelReporter(
+        lambda text, markup: edit_panel_text(cb.message, state, text=text, reply_markup=markup), PANEL_MIN_INTERVAL))
+    _job_controls[job.root()] = control
+    token, reporter = control.token, control.reporter
+    archive: Optional[StreamingArchive] = None
+    # zip не потокобезопасен: тексты и изображения пишутся в него из разных этапов
+    archive_lock = asyncio.Lock()
+    texts_task: Optional[asyncio.Task] = None
+    ticket = None
+    journal: Optional[JobJournal] = None
+    # .part сохраняем, только если задачу прервал рестарт (CancelledError): стоп и ошибки его удаляют
+    resumable = True
+    # Используем абсолютные пути, чтобы серверный ZIP и локальный фолбэк всегда видели корректные директории
+    out_root = os.path.abspath(f"{job.root()}/out")
+    archive_path = os.path.abspath(f"{job.root()}/archive.zip")
+
+    async def show_queue_position(pos: int):
+        reporter.update(f'В очереди: позиция {pos}. Задача начнётся автоматически.', stop_kb)
 
     try:
-        # 1) Генерация текстов - дожидаемся готовности ВСЕХ текстов
-        job.status = 'Генерация текстов'
-        job.progress = 10
-        job.save()
-        await edit_panel_text(cb.message, state, text='Генерация текстов… ' + progress_bar(job.progress), reply_markup=kb_simple([[('✖ Остановить', 'stop')]]))
-
-        # Используем введённое пользователем описание как исходные факты (source)
-        base_facts = {'source': job.base_description}
-        if getattr(job, 'structured_facts', None):
-            base_facts['structured'] = job.structured_facts
-        
-        # ВАЖНО: дожидаемся готовности ВСЕХ текстов перед продолжением
-        print(f"Запрос генерации {job.N} уникальных текстов...")
-        texts = await generate_texts(base_facts, job.base_description, job.N)
-        print(f"Получено {len(texts)} текстов, проверяем уникальность...")
-        
-        # Дополнительная проверка и обеспечение уникальности
-        final_texts = ensure_unique_texts(texts, job.base_description, min_difference=0.25)
-        while len(final_texts) < job.N:
-            final_texts.append(f"{job.base_description} [Дополнительный вариант {len(final_texts) + 1}]")
-        
-        # Обрезаем до нужного количества
-        texts = final_texts[:job.N]
-        
-        # Сохраним на диск для диагностики
-        try:
-            ensure_dir(job.root())
-            with open(f"{job.root()}/generated_texts.json", 'w', encoding='utf-8') as f:
-                json.dump(texts, f, ensure_ascii=False, indent=2)
-            print(f"Тексты сохранены: {len(texts)} уникальных вариантов")
-        except Exception as e:
-            print(f"Ошибка сохранения текстов: {e}")
-
-        if os.path.exists(stop_flag_path):
+        # 0) Очередь: общие лимиты нагрузки и очерёдность пользователей по кругу
+        ticket = await scheduler.acquire(job.user_id, job.root(), estimate_cost(job.N, job.M, job.unique_photos), show_queue_position)
+        if ticket is None:
             raise RuntimeError('stopped')
 
-        # 2) Аугментация изображений
+        # Журнал выполнения: после рестарта/повтора пропускаем уже сделанное (рендер детерминирован по seeded_rng)
+        journal = job_journal(job)
+        if journal.closed and os.path.exists(archive_path):
+            journal.close()
+            await reporter.close()
+            await _send_result(cb, state, job, archive_path)
+            journal.remove()
+            return
+        if journal.fresh:
+            # от прошлого запуска с другими параметрами ничего не переиспользуем
+            for stale in (archive_path + '.part', archive_path + '.part.prev'):
+                if os.path.exists(stale):
+                    os.remove(stale)
+        journal.open()
+
+        # Этапы идут как небольшой DAG: рендер не зависит от текстов, поэтому тексты генерируются
+        # параллельно с ним, а описание.txt каждого объявления пишется, как только готов его текст
         job.status = 'Аугментация изображений'
-        job.progress = 20
-        job.save()
-        await edit_panel_text(cb.message, state, text='Аугментация изображений… ' + progress_bar(job.progress), reply_markup=kb_simple([[('✖ Остановить', 'stop')]]))
+        job.progress = 10
+        jobs.flush(job)
+        reporter.update('Генерация текстов и аугментация изображений… ' + progress_bar(job.progress), stop_kb)
+
+        if ARCHIVE_MODE == 'folder':
+            ensure_dir(out_root)
+            # готовыми считаем файлы, которые лежат в out/ целиком (размер совпал с журналом)
+            finished = {
+                (v, m) for (v, m), rec in journal.images.items()
+                if os.path.exists(os.path.join(out_root, f"объявление {v+1:02d}", "фото", f"photo_{m+1:02d}.jpg"))
+                and os.path.getsize(os.path.join(out_root, f"объявление {v+1:02d}", "фото", f"photo_{m+1:02d}.jpg")) == rec['size']
+            }
+        else:
+            part_path = archive_path + '.part'
+            prev_path = part_path + '.prev'
+            if journal.images and os.path.exists(part_path) and not os.path.exists(prev_path):
+                os.replace(part_path, prev_path)
+            archive = StreamingArchive(archive_path, job.archive_name)
+            restored = {}
+            if journal.images and os.path.exists(prev_path):
+                restored = await asyncio.to_thread(_restore_archive, archive, prev_path, journal.images)
+            if journal.images:
+                journal.replace_images(restored)
+            if os.path.exists(prev_path):
+                os.remove(prev_path)
+            finished = set(restored)
+        if finished:
+            print(f"Продолжение задачи: готово {len(finished)} изображений из {job.N * job.M}")
+
+        async def write_description(v: int, ad_text: str):
+            ad_name = f"объявление {v+1:02d}"
+            if archive is not None:
+                async with archive_lock:
+                    await asyncio.to_thread(archive.add, f"{ad_name}/описание.txt", ad_text)
+            else:
+                with open(os.path.join(out_root, ad_name, "описание.txt"), 'w', encoding='utf-8') as f:
+                    f.write(ad_text)
+            print(f"Объявление {v+1}: сохранен уникальный текст ({len(ad_text)} символов)")
+
+        texts_task = asyncio.create_task(_text_stage(job, journal, write_description))
 
-        # Используем абсолютные пути, чтобы серверный ZIP и локальный фолбэк всегда видели корректные директории
-        out_root = os.path.abspath(f"{job.root()}/out")
-        ensure_dir(out_root)
         total = job.N * job.M
-        done = 0
+        done = len(finished)
+        tasks = []
         for v in range(job.N):
-            if os.path.exists(stop_flag_path):
-                raise RuntimeError('stopped')
-            ad_folder = os.path.join(out_root, f"объявление {v+1:02d}")
-            # Страхуем создание обоих уровней, чтобы запись описания не падала
-            ensure_dir(ad_folder)
-            photos_dir = os.path.join(ad_folder, "фото")
-            ensure_dir(photos_dir)
-            # УНИКАЛЬНЫЙ текст для каждого объявления
-            ad_text = texts[v] if v < len(texts) else f"{job.base_description} [Объявление №{v+1}]"
-            with open(os.path.join(ad_folder, "описание.txt"), 'w', encoding='utf-8') as f:
-                f.write(ad_text)
-            print(f"Объявление {v+1}: сохранен уникальный текст ({len(ad_text)} символов)")
+            if archive is not None:
+                photos_dir = None
+            else:
+                # Страхуем создание обоих уровней: рендер пишет фото, описание появится позже
+                photos_dir = os.path.join(out_root, f"объявление {v+1:02d}", "фото")
+                ensure_dir(photos_dir)
             for m in range(job.M):
-                if os.path.exists(stop_flag_path):
-                    raise RuntimeError('stopped')
+                if (v, m) in finished:
+                    continue
                 src = job.unique_photos[(v * job.M + m) % len(job.unique_photos)]
-                with Image.open(src['path']) as im:
-                    rng = seeded_rng(job.job_id, v, m)
-                    aug = soft_augment(im, rng)
-                    if job.watermark:
-                        with Image.open(job.watermark['filePath']) as wm:
-                            aug = apply_watermark(aug, wm, job.watermark.get('placement', 'br'), job.watermark.get('opacity', 70), job.watermark.get('margin', 24))
-                    aug.save(os.path.join(photos_dir, f"photo_{m+1:02d}.jpg"), format='JPEG', quality=92, subsampling=1, optimize=True)
-                done += 1
-                job.progress = 20 + int(70 * done / total)
-                if done % max(1, total // 20) == 0:
-                    job.save()
-                    await edit_panel_text(cb.message, state, text=f"Аугментация изображений: {done}/{total} (вариант {v+1} из {job.N})… " + progress_bar(job.progress), reply_markup=kb_simple([[('✖ Остановить', 'stop')]]))
-                # отдаём управление event loop, чтобы обрабатывались другие апдейты (например, Стоп)
-                if done % 5 == 0:
-                    await asyncio.sleep(0)
+                out_path = os.path.join(photos_dir, f"photo_{m+1:02d}.jpg") if photos_dir else None
+                tasks.append((src['path'], v, m, out_path))
+
+        # Рендер в пуле процессов пачками по исходникам; результаты приходят по мере готовности
+        batches = plan_batches(job.job_id, tasks, job.watermark, RENDER_CHUNK, AUGMENT_KERNEL, token.slot,
+                               JPEG_PROFILE, JPEG_TARGET_KB * 1024 or None)
+        meter = ThroughputMeter()
+        async for v, m, data in engine.render(batches):
+            if token.cancelled:
+                raise RuntimeError('stopped')
+            if archive is not None:
+                # JPEG сразу в архив (STORED), без записи в out/ и повторного чтения
+                async with archive_lock:
+                    rec = await asyncio.to_thread(_archive_put, archive, v, m, data)
+            else:
+                out_path = os.path.join(out_root, f"объявление {v+1:02d}", "фото", f"photo_{m+1:02d}.jpg")
+                rec = {'size': os.path.getsize(out_path), 'sha': await asyncio.to_thread(sha256_file, out_path)}
+            journal.record_image(v, m, **rec)
+            done += 1
+            job.progress = 20 + int(70 * done / total)
+            jobs.save(job)
+            # счётчик воркеров опережает пачки, которые ещё не вернулись, — по нему и скорость точнее
+            rendered = min(total, max(done, len(finished) + token.done))
+            meter.mark(rendered)
+            eta = format_eta(meter.eta(total - rendered))
+            texts_note = 'тексты готовы' if texts_task.done() else 'тексты генерируются'
+            reporter.update(f"Аугментация изображений: {rendered}/{total} (вариант {v+1} из {job.N})"
+                            + (f", осталось {eta}" if eta else '') + f"; {texts_note}… " + progress_bar(job.progress), stop_kb)
+
+        if not texts_task.done():
+            reporter.update('Изображения готовы, ждём тексты… ' + progress_bar(job.progress), stop_kb)
+        while not texts_task.done():
+            await asyncio.wait({texts_task}, timeout=0.5)
+            if token.cancelled:
+                raise RuntimeError('stopped')
+        # все описания к этому моменту уже в архиве/папке
+        await texts_task
 
         # 3) Сборка архива
-        if os.path.exists(stop_flag_path):
+        if token.cancelled:
             raise RuntimeError('stopped')
         job.status = 'Сборка архива'
         job.progress = 95
-        job.save()
-        await edit_panel_text(cb.message, state, text='Сборка архива… ' + progress_bar(job.progress), reply_markup=kb_simple([[('✖ Остановить', 'stop')]]))
-        # Строим manifest.json и README.txt в корне out_root
+        jobs.flush(job)
+        reporter.update('Сборка архива… ' + progress_bar(job.progress), stop_kb)
+        # Строим manifest.json и README.txt в корне архива
         import datetime
         manifest = {
             "jobId": job.job_id,
@@ -900,77 +1273,136 @@ async def run_job(cb: CallbackQuery, state: FSMContext):
                 "placement": (job.watermark.get('placement') if job.watermark else None),
                 "opacity": (job.watermark.get('opacity') if job.watermark else None),
                 "margin": (job.watermark.get('margin') if job.watermark else None)
-            }
+            },
+            "jpeg": {"profile": JPEG_PROFILE, "targetKB": JPEG_TARGET_KB or None}
         }
-        with open(os.path.join(out_root, 'manifest.json'), 'w', encoding='utf-8') as f:
-            json.dump(manifest, f, ensure_ascii=False, indent=2)
-        readme_path = os.path.join(out_root, 'README.txt')
-        with open(readme_path, 'w', encoding='utf-8') as f:
-            f.write('Пакет объявлений. Структура: объявление NN/фото/photo_XX.jpg и описание.txt\n')
-
-        archive_path = os.path.abspath(f"{job.root()}/archive.zip")
-        try:
-            payload = {
-                'inputFolders': [out_root],
-                'outputZipPath': archive_path,
-                'rootFolderName': job.archive_name,
-                'flatten': True,
-                'files': []
-            }
-            rr = await _http_post(f"{SERVER_URL}/zip/create", json_body=payload, timeout=600)
-            if rr.status_code != 200:
-                raise RuntimeError('zip via server failed')
-        except Exception:
-            # fallback to local zip (в отдельном потоке, чтобы не блокировать event loop)
-            await asyncio.to_thread(lambda: pack_job(out_root, archive_path, root_name=job.archive_name))
+        readme = 'Пакет объявлений. Структура: объявление NN/фото/photo_XX.jpg и описание.txt\n'
+        if archive is not None:
+            archive.add('manifest.json', json.dumps(manifest, ensure_ascii=False, indent=2))
+            archive.add('README.txt', readme)
+            await asyncio.to_thread(archive.close)
+        else:
+            with open(os.path.join(out_root, 'manifest.json'), 'w', encoding='utf-8') as f:
+                json.dump(manifest, f, ensure_ascii=False, indent=2)
+            with open(os.path.join(out_root, 'README.txt'), 'w', encoding='utf-8') as f:
+                f.write(readme)
+            packed = False
+            if ZIP_VIA_SERVER:
+                try:
+                    payload = {
+                        'inputFolders': [out_root],
+                        'outputZipPath': archive_path,
+                        'rootFolderName': job.archive_name,
+                        'flatten': True,
+                        'files': []
+                    }
+                    await api.post('/zip/create', payload)
+                    packed = True
+                except Exception as e:
+                    print(f"Сборка архива на сервере не удалась, пакуем локально: {e}")
+            if not packed:
+                # локальная сборка (в отдельном потоке, чтобы не блокировать event loop)
+                await asyncio.to_thread(lambda: pack_job(out_root, archive_path, root_name=job.archive_name, workers=ZIP_WORKERS))
+        journal.record_closed()
 
         # завершение
-        job.status = 'Готово'
-        job.progress = 100
-        job.save()
-        await edit_panel_text(cb.message, state, text='Готово! ' + progress_bar(100), reply_markup=None)
-        # Заменим панель финальным сообщением с архивом
-        await _delete_prev_panel(state, cb.message.chat.id)
-        doc_msg = await cb.message.answer_document(
-            FSInputFile(archive_path),
-            caption=f"Готово! Сгенерировано: {job.N} × {job.M} = {job.N*job.M} изображений. Архив: {os.path.basename(archive_path)}",
-            reply_markup=kb_simple([[('🔁 Ещё один пакет', 'start')], [('🗑 Удалить временные файлы', 'cleanup')]])
-        )
-        await state.update_data(panel_msg_id=doc_msg.message_id)
-        await state.set_state(States.Idle)
+        await reporter.close()
+        await _send_result(cb, state, job, archive_path)
+        journal.remove()
 
     except RuntimeError as e:
+        resumable = False
+        await reporter.close()
         if str(e) == 'stopped':
             job.status = 'Отменено'
-            job.save()
-            try:
-                os.remove(stop_flag_path)
-            except Exception:
-                pass
+            jobs.flush(job)
             await state.set_state(States.Confirm)
             await send_panel_msg(cb.message, state, text='Задача остановлена пользователем.', reply_markup=kb_simple([[('🔁 Запустить заново', 'confirm')]]))
             return
         await state.set_state(States.Confirm)
         await send_panel_msg(cb.message, state, text='Ошибка при выполнении задачи. Попробуйте ещё раз.', reply_markup=kb_simple([[('🔁 Повторить', 'confirm')]]))
     except Exception:
+        resumable = False
+        await reporter.close()
         await state.set_state(States.Confirm)
         await send_panel_msg(cb.message, state, text='Ошибка при выполнении задачи. Попробуйте ещё раз.', reply_markup=kb_simple([[('🔁 Повторить', 'confirm')]]))
+    finally:
+        # этап текстов не должен писать в архив после остановки/ошибки
+        if texts_task is not None and not texts_task.done():
+            texts_task.cancel()
+            try:
+                await texts_task
+            except BaseException:
+                pass
+        await reporter.close()
+        token.close()
+        _job_controls.pop(job.root(), None)
+        # после рестарта следующий запуск продолжит из .part; после стопа/ошибки недописанный архив удаляем
+        if archive is not None:
+            archive.abort(keep_part=resumable)
+        if journal is not None:
+            journal.close()
+        # задача выдана или вернулась в Confirm: в памяти её больше не держим, повтор прочитает job.json
+        jobs.evict(job)
+        scheduler.release(ticket)
+
+
+@router.callback_query(F.data.startswith('resume:'))
+async def resume_job(cb: CallbackQuery, state: FSMContext):
+    # кнопка из уведомления о прерванной задаче: FSM после рестарта пуст, восстанавливаем job_id
+    job = jobs.get(cb.from_user.id, cb.data.split(':', 1)[1])
+    if job is None:
+        await safe_cb_answer(cb, 'Задача не найдена', show_alert=True)
+        return
+    if await state.get_state() == States.Running.state:
+        await safe_cb_answer(cb, 'Сейчас уже идёт другая задача', show_alert=True)
+        return
+    await state.update_data(job_id=job.job_id)
+    await state.set_state(States.Confirm)
+    await run_job(cb, state)
+
+
+async def notify_interrupted_jobs():
+    # задачи, прерванные рестартом: помечаем и предлагаем продолжить с места остановки
+    for path in glob.glob('./workspace/*/*/job.json'):
+        # статус читаем прямо из job.json: в JobStore поднимаем только прерванные задачи
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if not isinstance(data, dict) or data.get('status') not in RUNNING_STATUSES:
+            continue
+        try:
+            job = jobs.get(int(data['user_id']), str(data['job_id']))
+        except (KeyError, TypeError, ValueError):
+            continue
+        if job is None:
+            continue
+        job.status = 'Прервано'
+        jobs.flush(job)
+        try:
+            await bot.send_message(
+                job.user_id,
+                f"Задача «{job.archive_name or job.job_id}» была прервана перезапуском бота. Готовые тексты и изображения сохранены — можно продолжить.",
+                reply_markup=kb_simple([[('▶ Продолжить', f'resume:{job.job_id}')]])
+            )
+        except Exception as e:
+            print(f"Не удалось уведомить о прерванной задаче {job.job_id}: {e}")
 
 
 @router.callback_query(States.Running, F.data == 'stop')
 async def stop_job(cb: CallbackQuery, state: FSMContext):
-    data = await state.get_data()
-    job_data = data.get('job')
-    if job_data:
-        job = JobData(**job_data)
-        with open(f"{job.root()}/.stop", 'w') as f:
-            f.write('1')
+    job = await current_job(state)
+    if job:
+        # если задача ещё ждёт в очереди — просто снимаем её
+        scheduler.cancel(job.root())
+        control = _job_controls.get(job.root())
         await safe_cb_answer(cb, 'Остановка запрошена')
-        # Пытаемся обновить панель, чтобы пользователь увидел уведомление
-        try:
-            await edit_panel_text(cb.message, state, text='Остановка запрошена. Завершение текущих шагов… ' + progress_bar(job.progress), reply_markup=None)
-        except Exception:
-            pass
+        if control is not None:
+            # флаг в общей памяти: воркеры бросят пачку перед следующим изображением
+            control.token.cancel()
+            control.reporter.update('Остановка запрошена. Завершение текущих шагов… ' + progress_bar(job.progress), None)
     else:
         await safe_cb_answer(cb, 'Нет активной задачи')
 
@@ -985,7 +1417,21 @@ async def main():
     except Exception:
         # Игнорируем прочие ошибки здесь — polling ниже всё равно попытается переподключиться
         pass
-    await dp.start_polling(bot)
+    # блобы, на которые не ссылается ни одна задача (например, после падения посреди удаления)
+    removed = await asyncio.to_thread(blobs.gc)
+    if removed:
+        print(f"Удалено блобов без ссылок: {removed}")
+    try:
+        await notify_interrupted_jobs()
+    except Exception as e:
+        print(f"Ошибка проверки прерванных задач: {e}")
+    try:
+        await dp.start_polling(bot)
+    finally:
+        jobs.flush_all()
+        await api.close()
+        engine.shutdown()
+        ingest_engine.shutdown()
 
 
 if __name__ == '__main__':
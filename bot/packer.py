@@ -1,14 +1,152 @@
 import os
+import struct
+import time
 import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 
-def pack_job(root_folder: str, archive_path: str, root_name: str | None = None):
+# Уже сжатые форматы кладём в архив без повторного сжатия
+STORED_EXTS = {'.jpg', '.jpeg', '.png', '.webp', '.gif', '.zip'}
+# Для остальных решаем по пробному сжатию начала файла: если выигрыш меньше
+# DEFLATE_MIN_SAVING, DEFLATE не окупает потраченный CPU
+SAMPLE_BYTES = 64 * 1024
+DEFLATE_MIN_SAVING = 0.1
+# Файлы крупнее этого не читаются в память целиком, а пишутся потоком
+PREFETCH_MAX_BYTES = 16 * 1024 * 1024
+
+
+def choose_compression(name: str, sample: bytes) -> int:
+    if os.path.splitext(name)[1].lower() in STORED_EXTS or not sample:
+        return zipfile.ZIP_STORED
+    sample = sample[:SAMPLE_BYTES]
+    saving = 1 - len(zlib.compress(sample, 1)) / len(sample)
+    return zipfile.ZIP_DEFLATED if saving >= DEFLATE_MIN_SAVING else zipfile.ZIP_STORED
+
+
+def _prepare_entry(abs_path: str, rel_path: str):
+    # выполняется в потоке: чтение с диска и выбор метода идут параллельно с записью архива
+    size = os.path.getsize(abs_path)
+    if size > PREFETCH_MAX_BYTES:
+        with open(abs_path, 'rb') as f:
+            sample = f.read(SAMPLE_BYTES)
+        return abs_path, rel_path, choose_compression(rel_path, sample), None
+    with open(abs_path, 'rb') as f:
+        data = f.read()
+    return abs_path, rel_path, choose_compression(rel_path, data), data
+
+
+def pack_job(root_folder: str, archive_path: str, root_name: str | None = None, level: int = 6, workers: int = 4):
+    """Пакует папку в zip: JPEG и прочее несжимаемое — STORED, остальное — DEFLATE.
+
+    Файлы читаются и классифицируются в пуле потоков на несколько записей вперёд;
+    запись в архив последовательная (zipfile не принимает заранее сжатые данные).
+    Архивы больше 4 ГБ пишутся как ZIP64.
+    """
     os.makedirs(os.path.dirname(archive_path), exist_ok=True)
-    with zipfile.ZipFile(archive_path, 'w', zipfile.ZIP_DEFLATED, compresslevel=9) as z:
-        for foldername, subfolders, filenames in os.walk(root_folder):
-            for filename in filenames:
-                abs_path = os.path.join(foldername, filename)
-                rel_path = os.path.relpath(abs_path, os.path.dirname(root_folder))
-                if root_name:
-                    rel_path = os.path.join(root_name, os.path.relpath(abs_path, root_folder))
-                z.write(abs_path, rel_path)
+    entries = []
+    for foldername, subfolders, filenames in os.walk(root_folder):
+        for filename in filenames:
+            abs_path = os.path.join(foldername, filename)
+            rel_path = os.path.relpath(abs_path, os.path.dirname(root_folder))
+            if root_name:
+                rel_path = os.path.join(root_name, os.path.relpath(abs_path, root_folder))
+            entries.append((abs_path, rel_path))
+
+    started = time.monotonic()
+    total = 0
+    with zipfile.ZipFile(archive_path, 'w', zipfile.ZIP_DEFLATED, compresslevel=level, allowZip64=True) as z, \
+            ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        # в полёте не больше 2×workers файлов, чтобы не держать в памяти всю папку
+        ahead = max(1, workers) * 2
+        futures = [pool.submit(_prepare_entry, *e) for e in entries[:ahead]]
+        for i in range(len(entries)):
+            abs_path, rel_path, method, data = futures[i].result()
+            futures[i] = None
+            if i + ahead < len(entries):
+                futures.append(pool.submit(_prepare_entry, *entries[i + ahead]))
+            if data is None:
+                z.write(abs_path, rel_path, compress_type=method)
+                total += os.path.getsize(abs_path)
+            else:
+                zinfo = zipfile.ZipInfo.from_file(abs_path, rel_path)
+                zinfo.compress_type = method
+                z.writestr(zinfo, data, compress_type=method, compresslevel=level)
+                total += len(data)
+    elapsed = max(time.monotonic() - started, 1e-6)
+    print(f"Архив {os.path.basename(archive_path)}: {len(entries)} файлов, {total / 1e6:.1f} МБ "
+          f"за {elapsed:.1f} с ({total / 1e6 / elapsed:.1f} МБ/с)")
     return archive_path
+
+
+class StreamingArchive:
+    """Zip, который пополняется по мере готовности данных, без промежуточной папки out/.
+
+    Пишем в <archive>.part и переименовываем при close(), чтобы недописанный
+    архив никогда не выглядел готовым.
+    """
+
+    def __init__(self, archive_path: str, root_name: str | None = None):
+        os.makedirs(os.path.dirname(archive_path), exist_ok=True)
+        self.path = archive_path
+        self.part_path = archive_path + '.part'
+        self.root_name = root_name
+        self._zip = zipfile.ZipFile(self.part_path, 'w', zipfile.ZIP_DEFLATED)
+
+    def add(self, name: str, data: bytes | str) -> zipfile.ZipInfo:
+        arcname = f"{self.root_name}/{name}" if self.root_name else name
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        zinfo = zipfile.ZipInfo(arcname, date_time=time.localtime(time.time())[:6])
+        zinfo.external_attr = 0o644 << 16
+        zinfo.compress_type = choose_compression(name, data)
+        self._zip.writestr(zinfo, data)
+        # после записи в zinfo лежат header_offset, CRC и размеры — их пишет журнал задачи
+        return zinfo
+
+    def flush(self):
+        self._zip.fp.flush()
+
+    @property
+    def closed(self) -> bool:
+        return self._zip.fp is None
+
+    def close(self) -> str:
+        if not self.closed:
+            self._zip.close()
+            os.replace(self.part_path, self.path)
+        return self.path
+
+    def abort(self, keep_part: bool = False):
+        if not self.closed:
+            self._zip.close()
+            if keep_part:
+                return
+            try:
+                os.remove(self.part_path)
+            except OSError:
+                pass
+
+
+_LOCAL_HEADER = struct.Struct('<4s5H3L2H')
+
+
+def read_stored_entry(f, header_offset: int, size: int, crc: int) -> bytes | None:
+    """Читает STORED-запись по смещению локального заголовка (в т.ч. из недописанного .part).
+
+    Возвращает данные, только если заголовок валиден и CRC совпал, иначе None.
+    """
+    try:
+        f.seek(header_offset)
+        header = f.read(_LOCAL_HEADER.size)
+        if len(header) != _LOCAL_HEADER.size:
+            return None
+        fields = _LOCAL_HEADER.unpack(header)
+        if fields[0] != b'PK\x03\x04' or fields[3] != zipfile.ZIP_STORED:
+            return None
+        f.seek(header_offset + _LOCAL_HEADER.size + fields[9] + fields[10])
+        data = f.read(size)
+    except OSError:
+        return None
+    if len(data) != size or zlib.crc32(data) != crc:
+        return None
+    return data
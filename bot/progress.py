@@ -0,0 +1,119 @@
+import asyncio
+import time
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Optional
+
+from aiogram.exceptions import TelegramRetryAfter
+
+from render import CancelToken
+
+
+def format_eta(seconds: Optional[float]) -> str:
+    if seconds is None:
+        return ''
+    seconds = int(seconds + 0.5)
+    if seconds < 60:
+        return f'~{seconds} с'
+    if seconds < 3600:
+        return f'~{seconds // 60} мин {seconds % 60:02d} с'
+    return f'~{seconds // 3600} ч {seconds % 3600 // 60:02d} мин'
+
+
+class ThroughputMeter:
+    """Скорость (шт/с) по фактическим завершениям, сглаженная EWMA; из неё — ETA."""
+
+    def __init__(self, alpha: float = 0.3, min_window: float = 1.0):
+        self.alpha = alpha
+        self.min_window = min_window
+        self.rate: Optional[float] = None
+        self._t: Optional[float] = None
+        self._n = 0
+
+    def mark(self, done: int):
+        now = time.monotonic()
+        if self._t is None:
+            self._t, self._n = now, done
+            return
+        dt = now - self._t
+        # слишком короткие окна дают шумную скорость — копим хотя бы min_window секунд
+        if dt < self.min_window or done <= self._n:
+            return
+        rate = (done - self._n) / dt
+        self.rate = rate if self.rate is None else self.alpha * rate + (1 - self.alpha) * self.rate
+        self._t, self._n = now, done
+
+    def eta(self, remaining: int) -> Optional[float]:
+        if not self.rate or remaining <= 0:
+            return None
+        return remaining / self.rate
+
+
+class PanelReporter:
+    """Единственный отправитель правок панели задачи.
+
+    update() только запоминает последний текст; фоновая задача отправляет его не
+    чаще раза в min_interval секунд, промежуточные состояния схлопываются. После
+    429 (TelegramRetryAfter) ждём указанное время и удваиваем интервал (до max_interval).
+    """
+
+    def __init__(self, edit: Callable[[str, Any], Awaitable[None]], min_interval: float = 3.0, max_interval: float = 30.0):
+        self._edit = edit
+        self.interval = min_interval
+        self.max_interval = max_interval
+        self._pending: Optional[tuple] = None
+        self._last: Optional[tuple] = None
+        self._next_at = 0.0
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._closed = False
+
+    def update(self, text: str, reply_markup: Any = None):
+        if self._closed:
+            return
+        self._pending = (text, reply_markup)
+        self._wake.set()
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._wake.wait()
+            self._wake.clear()
+            delay = self._next_at - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            item, self._pending = self._pending, None
+            if item is None or item == self._last:
+                continue
+            try:
+                await self._edit(*item)
+                self._last = item
+                self._next_at = loop.time() + self.interval
+            except TelegramRetryAfter as e:
+                self.interval = min(self.max_interval, self.interval * 2)
+                self._next_at = loop.time() + e.retry_after
+                if self._pending is None:
+                    self._pending = item
+                self._wake.set()
+            except Exception as e:
+                print(f"Ошибка обновления панели: {e}")
+                self._next_at = loop.time() + self.interval
+
+    async def close(self):
+        # недоотправленное состояние отбрасываем: дальше панелью управляет вызывающий код
+        self._closed = True
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+@dataclass
+class JobControl:
+    """Канал управления идущей задачей: отмена (в т.ч. в воркерах) и панель прогресса."""
+    token: CancelToken
+    reporter: PanelReporter
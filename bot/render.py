@@ -0,0 +1,189 @@
+import asyncio
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import AsyncIterator, Dict, Iterable, List, Optional
+
+from PIL import Image
+
+from image_pipeline import seeded_rng, get_augment, apply_watermark, encode_jpeg
+from utils.framecache import FrameCache
+
+# Кэш кадров живёт в каждом процессе пула (см. _init_worker)
+_frames: Optional[FrameCache] = None
+# Общая с главным процессом память: флаги отмены и счётчики готовых изображений по слотам задач
+_cancel = None
+_done = None
+
+# Сколько задач одновременно могут иметь свой слот отмены/прогресса
+CONTROL_SLOTS = 64
+
+
+def _init_worker(frame_cache_bytes: int, cancel=None, done=None):
+    global _frames, _cancel, _done
+    _frames = FrameCache(frame_cache_bytes)
+    _cancel = cancel
+    _done = done
+
+
+# Пачка задач рендера для одного исходника: [(вариант v, фото m, out_path), ...].
+# Выполняется в процессе пула, поэтому функция должна быть на уровне модуля (pickle).
+# Если out_path не задан, JPEG возвращается байтами (для потоковой записи в архив).
+# slot — слот задачи в общей памяти: отмена проверяется перед каждым изображением.
+# jpeg_profile / jpeg_target — профиль кодировщика и необязательный потолок размера файла (байт).
+def render_batch(job_id: str, src_path: str, items: List[tuple], watermark: Optional[dict] = None, kernel: str = 'pil',
+                 slot: Optional[int] = None, jpeg_profile: str = 'legacy', jpeg_target: Optional[int] = None):
+    augment = get_augment(kernel)
+    src = _frames.image(src_path) if _frames is not None else None
+    out = []
+    for v, m, out_path in items:
+        if slot is not None and _cancel is not None and _cancel[slot]:
+            break
+        if src is None:
+            with Image.open(src_path) as im:
+                aug = augment(im, seeded_rng(job_id, v, m))
+        else:
+            aug = augment(src, seeded_rng(job_id, v, m))
+        if watermark:
+            # логотип открывается и масштабируется только при промахе кэша
+            aug = apply_watermark(aug, watermark['filePath'], watermark.get('placement', 'br'), watermark.get('opacity', 70),
+                                  watermark.get('margin', 24), key=watermark.get('sha256'))
+        data = encode_jpeg(aug, jpeg_profile, jpeg_target)
+        if out_path:
+            with open(out_path, 'wb') as f:
+                f.write(data)
+            out.append((v, m, None))
+        else:
+            out.append((v, m, data))
+        if slot is not None and _done is not None:
+            with _done.get_lock():
+                _done[slot] += 1
+    return out
+
+
+def plan_batches(job_id: str, assignments: Iterable[tuple], watermark: Optional[dict], chunk: int, kernel: str = 'pil',
+                 slot: Optional[int] = None, jpeg_profile: str = 'legacy', jpeg_target: Optional[int] = None) -> List[tuple]:
+    """Группирует задачи (src_path, v, m, out_path) по исходнику и режет на пачки.
+
+    Пачки одного исходника идут подряд, поэтому кадр из кэша воркера
+    переиспользуется, а не декодируется заново для каждого варианта.
+    """
+    by_src: Dict[str, List[tuple]] = {}
+    for src_path, v, m, out_path in assignments:
+        by_src.setdefault(src_path, []).append((v, m, out_path))
+    batches = []
+    for src_path, items in by_src.items():
+        for i in range(0, len(items), max(1, chunk)):
+            batches.append((job_id, src_path, items[i:i + chunk], watermark, kernel, slot, jpeg_profile, jpeg_target))
+    return batches
+
+
+class CancelToken:
+    """Отмена и счётчик прогресса задачи, видимые воркерам пула (слот в общей памяти).
+
+    Если свободных слотов нет (slot is None), отмена работает только в главном
+    процессе: воркеры доделают уже отправленные пачки.
+    """
+
+    def __init__(self, engine: 'RenderEngine', slot: Optional[int]):
+        self._engine = engine
+        self.slot = slot
+        self._cancelled = False
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled
+
+    @property
+    def done(self) -> int:
+        # изображения, готовые в воркерах (включая пачки, которые ещё не вернулись)
+        return self._engine._done[self.slot] if self.slot is not None else 0
+
+    def cancel(self):
+        self._cancelled = True
+        if self.slot is not None:
+            self._engine._cancel[self.slot] = 1
+
+    def close(self):
+        if self.slot is not None:
+            self._engine._release_slot(self.slot)
+            self.slot = None
+
+
+class RenderEngine:
+    """Пул процессов для CPU-тяжёлой работы (аугментация, водяная марка, JPEG)."""
+
+    def __init__(self, workers: int, start_method: str = 'spawn', frame_cache_bytes: int = 256 * 1024 * 1024):
+        self.workers = max(1, workers)
+        self.start_method = start_method
+        self.frame_cache_bytes = frame_cache_bytes
+        self._pool: Optional[ProcessPoolExecutor] = None
+        ctx = multiprocessing.get_context(self.start_method)
+        # передаются воркерам при старте (initargs), поэтому работают и со spawn
+        self._cancel = ctx.Array('b', CONTROL_SLOTS, lock=False)
+        self._done = ctx.Array('q', CONTROL_SLOTS)
+        # FIFO: освобождённый слот выдаётся последним — пачки отменённой задачи успеют догореть
+        self._free_slots = deque(range(CONTROL_SLOTS))
+
+    def _executor(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            ctx = multiprocessing.get_context(self.start_method)
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=ctx, initializer=_init_worker,
+                                             initargs=(self.frame_cache_bytes, self._cancel, self._done))
+        return self._pool
+
+    def cancel_token(self) -> CancelToken:
+        slot = self._free_slots.popleft() if self._free_slots else None
+        if slot is not None:
+            self._cancel[slot] = 0
+            self._done[slot] = 0
+        return CancelToken(self, slot)
+
+    def _release_slot(self, slot: int):
+        # флаг отмены не сбрасываем: его обнулит следующая выдача слота
+        self._free_slots.append(slot)
+
+    async def run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor(), fn, *args)
+
+    async def map_unordered(self, fn, tasks: Iterable[tuple]) -> AsyncIterator:
+        """Отправляет задачи в пул и отдаёт результаты по мере готовности.
+
+        В полёте держим не больше 2×workers задач, чтобы остановка задачи
+        не ждала разбора длинной очереди.
+        """
+        loop = asyncio.get_running_loop()
+        pool = self._executor()
+        it = iter(tasks)
+        pending = set()
+        limit = self.workers * 2
+
+        def fill():
+            while len(pending) < limit:
+                args = next(it, None)
+                if args is None:
+                    return
+                pending.add(loop.run_in_executor(pool, fn, *args))
+
+        try:
+            fill()
+            while pending:
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for fut in done:
+                    pending.discard(fut)
+                    yield fut.result()
+                fill()
+        finally:
+            for fut in pending:
+                fut.cancel()
+
+    async def render(self, batches: Iterable[tuple]) -> AsyncIterator:
+        async for res in self.map_unordered(render_batch, batches):
+            for item in res:
+                yield item
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
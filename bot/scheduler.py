@@ -0,0 +1,168 @@
+import asyncio
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, Hashable, Optional
+
+# Средний размер исходника, если размеры фото неизвестны (мегапиксели)
+DEFAULT_MP = 12.0
+
+
+def estimate_cost(n: int, m: int, photos: list) -> float:
+    """Стоимость задачи в «мегапиксель-изображениях»: N × M × средний размер исходника."""
+    sizes = [p['width'] * p['height'] / 1e6 for p in photos if p.get('width') and p.get('height')]
+    avg = sum(sizes) / len(sizes) if sizes else DEFAULT_MP
+    return n * m * avg
+
+
+class Ticket:
+    __slots__ = ('user_id', 'key', 'cost', 'position', 'granted', 'cancelled', 'changed')
+
+    def __init__(self, user_id: int, key: Hashable, cost: float):
+        self.user_id = user_id
+        self.key = key
+        self.cost = cost
+        self.position = 0
+        self.granted = False
+        self.cancelled = False
+        self.changed = asyncio.Event()
+
+
+class JobScheduler:
+    """Очередь подтверждённых задач с глобальными лимитами и честной очерёдностью пользователей.
+
+    Ограничения: число одновременных задач, суммарная стоимость в работе и число задач
+    одного пользователя. Пользователи обслуживаются по кругу (round-robin), внутри
+    пользователя — FIFO. Задачу, упёршуюся в лимит стоимости, никто из следующих не обгоняет;
+    задача дороже max_cost запускается, когда больше ничего не идёт.
+    """
+
+    def __init__(self, max_jobs: int = 2, max_cost: float = 30000.0, per_user: int = 1):
+        self.max_jobs = max(1, max_jobs)
+        self.max_cost = max_cost
+        self.per_user = max(1, per_user)
+        self._queues: Dict[int, Deque[Ticket]] = {}
+        self._tickets: Dict[Hashable, Ticket] = {}
+        self._running: Dict[int, int] = {}
+        self._running_jobs = 0
+        self._running_cost = 0.0
+        # с какого момента ждёт голова очереди пользователя (выдача слота или приход) — для кругового обхода
+        self._turn: Dict[int, int] = {}
+        self._seq = 0
+
+    def is_active(self, key: Hashable) -> bool:
+        return key in self._tickets
+
+    async def acquire(self, user_id: int, key: Hashable, cost: float,
+                      on_position: Optional[Callable[[int], Awaitable[None]]] = None) -> Optional[Ticket]:
+        """Ждёт слот. Возвращает Ticket или None, если задачу отменили в очереди."""
+        if key in self._tickets:
+            return None
+        ticket = Ticket(user_id, key, cost)
+        self._tickets[key] = ticket
+        if user_id not in self._queues:
+            # пришедший пользователь встаёт в круг за теми, кто уже ждёт
+            self._seq += 1
+            self._turn[user_id] = self._seq
+        self._queues.setdefault(user_id, deque()).append(ticket)
+        self._dispatch()
+        reported = None
+        try:
+            while True:
+                ticket.changed.clear()
+                if ticket.granted:
+                    return ticket
+                if ticket.cancelled:
+                    return None
+                if on_position and ticket.position != reported:
+                    reported = ticket.position
+                    try:
+                        await on_position(reported)
+                    except Exception:
+                        pass
+                await ticket.changed.wait()
+        except asyncio.CancelledError:
+            self._drop(ticket)
+            raise
+
+    def cancel(self, key: Hashable) -> bool:
+        """Снимает задачу из очереди (если она ещё не запущена)."""
+        ticket = self._tickets.get(key)
+        if ticket is None or ticket.granted:
+            return False
+        self._drop(ticket)
+        ticket.cancelled = True
+        ticket.changed.set()
+        self._dispatch()
+        return True
+
+    def release(self, ticket: Optional[Ticket]):
+        if ticket is None or not ticket.granted:
+            return
+        self._tickets.pop(ticket.key, None)
+        self._running[ticket.user_id] -= 1
+        if not self._running[ticket.user_id]:
+            del self._running[ticket.user_id]
+        self._running_jobs -= 1
+        self._running_cost -= ticket.cost
+        ticket.granted = False
+        self._dispatch()
+
+    def _drop(self, ticket: Ticket):
+        self._tickets.pop(ticket.key, None)
+        q = self._queues.get(ticket.user_id)
+        if q and ticket in q:
+            q.remove(ticket)
+            if not q:
+                del self._queues[ticket.user_id]
+
+    def _fits(self, ticket: Ticket) -> bool:
+        if self._running_jobs >= self.max_jobs:
+            return False
+        if self._running.get(ticket.user_id, 0) >= self.per_user:
+            return False
+        return self._running_jobs == 0 or self._running_cost + ticket.cost <= self.max_cost
+
+    def _order(self) -> list:
+        return sorted(self._queues, key=lambda u: self._turn.get(u, 0))
+
+    def _dispatch(self):
+        # выдаём слоты по кругу: первым идёт тот, кто дольше всех ждёт
+        progressed = True
+        while progressed and self._queues:
+            progressed = False
+            for user_id in self._order():
+                q = self._queues[user_id]
+                if self._running.get(user_id, 0) >= self.per_user:
+                    continue
+                if not self._fits(q[0]):
+                    # очередь этого пользователя упёрлась в общий лимит: следующих не пускаем вперёд,
+                    # иначе дорогая задача будет вечно уступать потоку дешёвых
+                    break
+                ticket = q.popleft()
+                if not q:
+                    del self._queues[user_id]
+                self._seq += 1
+                self._turn[user_id] = self._seq
+                ticket.granted = True
+                self._running[user_id] = self._running.get(user_id, 0) + 1
+                self._running_jobs += 1
+                self._running_cost += ticket.cost
+                ticket.changed.set()
+                progressed = True
+                break
+        self._update_positions()
+
+    def _update_positions(self):
+        # позиция = порядковый номер в круговом обходе очередей пользователей
+        queues = [list(self._queues[u]) for u in self._order()]
+        pos = 1
+        depth = 0
+        while True:
+            layer = [q[depth] for q in queues if depth < len(q)]
+            if not layer:
+                break
+            for ticket in layer:
+                if ticket.position != pos:
+                    ticket.position = pos
+                    ticket.changed.set()
+                pos += 1
+            depth += 1
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# модули бота импортируются как верхнеуровневые (как при запуске из bot/)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
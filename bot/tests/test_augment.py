@@ -0,0 +1,53 @@
+import hashlib
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from image_pipeline import get_augment, seeded_rng, soft_augment, soft_augment_fused
+
+SEEDS = range(5)
+# sha256 пикселей soft_augment до появления fused-ядра (Pillow 10.4.0 из requirements.txt):
+# ядро pil обязано выдавать побайтно то же самое
+PIL_GOLDEN = {
+    0: '2c6b34d27175bca08492b759c302665d8adc5cf3192396a813746ac1bf372958',
+    1: 'be2062872c9c02c6eda9533921e8d61548f4f7807998eb5ded190881665f397d',
+    2: '73b45f14a6a30b25f00756d43e4e811510b2d42c42db5646047e5f30212109db',
+    3: 'd66cdcafa56d60b9d83e4c996c106c7b6dcb2730cc4fb5092d6d47881a61e677',
+    4: 'e289a2e32171a08daf560560e0bc3bf5ee1146e5be9cb2eee4dc9745f67df88d',
+}
+MIN_PSNR = 33.0
+MAX_MEAN_ERROR = 3.0
+
+
+@pytest.fixture(scope='module')
+def sample() -> Image.Image:
+    # гладкие градиенты с лёгким шумом — ближе к фото, чем чистый шум
+    y, x = np.mgrid[0:360, 0:480].astype(np.float64)
+    arr = np.stack([128 + 100 * np.sin(x / 37), 128 + 90 * np.cos(y / 23), 96 + (x + y) / 6], -1)
+    arr = arr + np.random.default_rng(0).normal(0, 3, arr.shape)
+    return Image.fromarray(np.clip(arr, 0, 255).astype(np.uint8))
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_pil_kernel_is_byte_identical(sample, seed):
+    out = get_augment('pil')(sample, seeded_rng('parity', seed, 0))
+    assert hashlib.sha256(out.tobytes()).hexdigest() == PIL_GOLDEN[seed]
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_fused_kernel_matches_pil(sample, seed):
+    ref = soft_augment(sample, seeded_rng('parity', seed, 0))
+    out = soft_augment_fused(sample, seeded_rng('parity', seed, 0))
+    assert out.size == ref.size
+    assert out.mode == ref.mode
+    err = np.asarray(out, dtype=np.float64) - np.asarray(ref, dtype=np.float64)
+    psnr = 10 * np.log10(255 ** 2 / np.mean(err ** 2))
+    assert psnr >= MIN_PSNR
+    assert np.abs(err).mean() <= MAX_MEAN_ERROR
+
+
+def test_fused_kernel_is_deterministic(sample):
+    a = soft_augment_fused(sample, seeded_rng('parity', 7, 1))
+    b = soft_augment_fused(sample, seeded_rng('parity', 7, 1))
+    assert a.tobytes() == b.tobytes()
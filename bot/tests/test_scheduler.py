@@ -0,0 +1,81 @@
+import asyncio
+
+import pytest
+
+from scheduler import JobScheduler
+
+
+async def _settle():
+    for _ in range(3):
+        await asyncio.sleep(0)
+
+
+@pytest.mark.parametrize('big_cost', [90, 150])
+def test_cost_blocked_head_is_not_overtaken(big_cost):
+    async def scenario():
+        s = JobScheduler(max_jobs=2, max_cost=100, per_user=1)
+        a = await s.acquire(1, 'a', 30)
+        b = await s.acquire(2, 'b', 30)
+        big = asyncio.create_task(s.acquire(3, 'big', big_cost))
+        await _settle()
+        # постоянный поток дешёвых задач от других пользователей
+        small = [asyncio.create_task(s.acquire(u, f'{u}-{i}', 30)) for i in range(3) for u in (1, 2, 4)]
+        await _settle()
+
+        s.release(a)
+        await _settle()
+        assert not big.done()
+        assert not any(t.done() for t in small)
+
+        s.release(b)
+        await _settle()
+        ticket = big.result()
+        assert ticket is not None and ticket.granted
+        assert not any(t.done() for t in small)
+
+        s.release(ticket)
+        await _settle()
+        assert sum(t.done() for t in small) == 2
+        for t in small:
+            t.cancel()
+
+    asyncio.run(scenario())
+
+
+def test_per_user_limit_does_not_block_others():
+    async def scenario():
+        s = JobScheduler(max_jobs=2, max_cost=100, per_user=1)
+        a = await s.acquire(1, 'a', 30)
+        queued = asyncio.create_task(s.acquire(1, 'a2', 30))
+        other = asyncio.create_task(s.acquire(2, 'b', 30))
+        await _settle()
+        assert other.done() and other.result().granted
+        assert not queued.done()
+        s.release(a)
+        await _settle()
+        assert queued.result().granted
+
+    asyncio.run(scenario())
+
+
+def test_new_users_do_not_overtake_blocked_head():
+    async def scenario():
+        s = JobScheduler(max_jobs=2, max_cost=100, per_user=1)
+        # пользователь 3 уже обслуживался раньше
+        s.release(await s.acquire(3, 'warmup', 10))
+        a = await s.acquire(1, 'a', 30)
+        b = await s.acquire(2, 'b', 30)
+        big = asyncio.create_task(s.acquire(3, 'big', 90))
+        await _settle()
+        fresh = [asyncio.create_task(s.acquire(u, f'new-{u}', 30)) for u in range(10, 16)]
+        await _settle()
+        s.release(a)
+        await _settle()
+        assert not any(t.done() for t in fresh)
+        s.release(b)
+        await _settle()
+        assert big.result().granted
+        for t in fresh:
+            t.cancel()
+
+    asyncio.run(scenario())
@@ -0,0 +1,71 @@
+import random
+
+import pytest
+
+from utils.textuniq import UniqueTexts, jaccard, shingles
+
+
+def _brute_force(texts, min_difference, shingle=1):
+    # эталон: тот же жадный отбор, но с точным Жаккаром против всех уже принятых текстов
+    mark = lambda text, i: f"{text} [Объявление №{i+1}]"
+    out, sets = [], []
+    for i, text in enumerate(texts):
+        clean = text.strip()
+        sh = shingles(clean, shingle)
+        if not clean or clean in out or any(1.0 - jaccard(sh, prev) < min_difference for prev in sets):
+            clean = mark(clean, i)
+            sh = shingles(clean, shingle)
+        out.append(clean)
+        sets.append(sh)
+    return out
+
+
+def _run(texts, min_difference, shingle=1):
+    acc = UniqueTexts(min_difference, shingle)
+    for t in texts:
+        acc.add(t)
+    return acc.texts
+
+
+def _variant(rng, base, replace, vocab):
+    words = list(base)
+    for pos in rng.sample(range(len(words)), replace):
+        words[pos] = rng.choice(vocab)
+    return ' '.join(words)
+
+
+@pytest.mark.parametrize('seed', range(20))
+@pytest.mark.parametrize('min_difference', [0.1, 0.25, 0.3, 0.5])
+def test_matches_brute_force_on_random_variants(seed, min_difference):
+    rng = random.Random(seed)
+    vocab = [f'слово{i}' for i in range(400)]
+    bases = [rng.sample(vocab, rng.randint(5, 60)) for _ in range(4)]
+    texts = []
+    for _ in range(60):
+        base = rng.choice(bases)
+        texts.append(_variant(rng, base, rng.randint(0, len(base) // 2), vocab))
+    texts += ['', '   ', texts[0], texts[1].upper()]
+    rng.shuffle(texts)
+    assert _run(texts, min_difference) == _brute_force(texts, min_difference)
+
+
+@pytest.mark.parametrize('min_difference', [0.1, 0.25, 0.3, 0.5])
+@pytest.mark.parametrize('union', [10, 20, 40, 100])
+def test_pairs_around_threshold(min_difference, union):
+    # пары с Жаккаром на пороге и на одно слово по обе стороны от него
+    limit = int(round(union * (1.0 - min_difference)))
+    for inter in (limit - 1, limit, limit + 1):
+        if not 0 < inter < union:
+            continue
+        common = [f'общее{i}' for i in range(inter)]
+        rest = union - inter
+        a = ' '.join(common + [f'левое{i}' for i in range(rest // 2)])
+        b = ' '.join(common + [f'правое{i}' for i in range(rest - rest // 2)])
+        expected = _brute_force([a, b], min_difference)
+        assert _run([a, b], min_difference) == expected
+        assert (expected[1] == b) == (1.0 - inter / union >= min_difference)
+
+
+def test_shingles_of_two_words():
+    texts = ['a b c d e f', 'a b c d e g', 'f e d c b a']
+    assert _run(texts, 0.3, shingle=2) == _brute_force(texts, 0.3, shingle=2)
@@ -0,0 +1,71 @@
+import os
+import shutil
+import time
+from typing import Optional
+
+from utils.fileio import ensure_dir, link_or_copy, sha256_file
+
+# Контентно-адресуемое хранилище: <root>/ab/cd/<sha256><ext>.
+# Рабочие папки задач держат на блоб жёсткие ссылки, поэтому счётчик ссылок —
+# это st_nlink: блоб с nlink == 1 больше никем не используется. Если ФС не дала
+# сделать ссылку, задача получает копию и на блоб не ссылается: такой блоб
+# удалится при release()/gc(), а копия задачи останется.
+
+
+class BlobStore:
+    def __init__(self, root: str):
+        self.root = os.path.abspath(root)
+        ensure_dir(self.root)
+
+    def path(self, sha: str, ext: str = '') -> str:
+        return os.path.join(self.root, sha[:2], sha[2:4], sha + ext)
+
+    def has(self, sha: str, ext: str = '') -> bool:
+        return os.path.exists(self.path(sha, ext))
+
+    def put_file(self, src: str, sha: Optional[str] = None, ext: str = '') -> str:
+        """Переносит файл в хранилище (src исчезает) и возвращает его sha256."""
+        sha = sha or sha256_file(src)
+        dst = self.path(sha, ext)
+        if os.path.exists(dst):
+            os.remove(src)
+        else:
+            ensure_dir(os.path.dirname(dst))
+            try:
+                os.replace(src, dst)
+            except OSError:
+                shutil.move(src, dst)
+        return sha
+
+    def link(self, sha: str, dest: str, ext: str = '') -> str:
+        if not link_or_copy(self.path(sha, ext), dest):
+            print(f"Блоб {sha[:12]}{ext}: жёсткая ссылка не создана, задача получила копию")
+        return dest
+
+    def release(self, sha: str, ext: str = '') -> bool:
+        """Удаляет блоб, если на него не осталось ссылок из рабочих папок."""
+        p = self.path(sha, ext)
+        try:
+            if os.stat(p).st_nlink <= 1:
+                os.remove(p)
+                return True
+        except FileNotFoundError:
+            pass
+        return False
+
+    def gc(self, min_age: float = 0.0) -> int:
+        """Удаляет блобы без ссылок; блобы моложе min_age секунд не трогает
+        (их могли только что положить и ещё не успеть связать с задачей)."""
+        removed = 0
+        now = time.time()
+        for root, dirs, files in os.walk(self.root):
+            for name in files:
+                p = os.path.join(root, name)
+                try:
+                    st = os.stat(p)
+                    if st.st_nlink <= 1 and now - st.st_mtime >= min_age:
+                        os.remove(p)
+                        removed += 1
+                except FileNotFoundError:
+                    pass
+        return removed
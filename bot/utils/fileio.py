@@ -1,9 +1,13 @@
 import hashlib
 import os
+import shutil
 from PIL import Image, ImageOps
+import aiohttp
 import requests
 from io import BytesIO
 
+from utils.phash import phash
+
 
 def sha256_file(path: str) -> str:
     h = hashlib.sha256()
@@ -25,6 +29,19 @@ def download_telegram_file(file_url: str, dest_path: str):
         f.write(r.content)
 
 
+async def download_stream(session: aiohttp.ClientSession, url: str, dest_path: str, *, timeout: int = 120, chunk_size: int = 1 << 16) -> str:
+    """Потоково пишет ответ в файл и считает sha256 на лету; возвращает hex-дайджест."""
+    ensure_dir(os.path.dirname(dest_path))
+    h = hashlib.sha256()
+    async with session.get(url, timeout=aiohttp.ClientTimeout(total=timeout)) as r:
+        r.raise_for_status()
+        with open(dest_path, 'wb') as f:
+            async for chunk in r.content.iter_chunked(chunk_size):
+                h.update(chunk)
+                f.write(chunk)
+    return h.hexdigest()
+
+
 def normalize_exif(path_in: str, path_out: str):
     ensure_dir(os.path.dirname(path_out))
     with Image.open(path_in) as im:
@@ -32,6 +49,36 @@ def normalize_exif(path_in: str, path_out: str):
         im.convert('RGB').save(path_out, format='JPEG', quality=92, subsampling=1, optimize=True)
 
 
+def link_or_copy(src: str, dst: str) -> bool:
+    """Жёсткая ссылка, а если ФС не умеет — копия; True, если получилась ссылка."""
+    ensure_dir(os.path.dirname(dst))
+    try:
+        os.link(src, dst)
+        return True
+    except OSError:
+        shutil.copyfile(src, dst)
+        return False
+
+
+def ingest_image(path_in: str, path_out: str) -> dict:
+    """Одно декодирование: EXIF-нормализованный JPEG (как normalize_exif), его sha256, pHash и размеры.
+
+    sha256 считается по закодированным байтам в памяти, pHash — по тем же пикселям
+    до кодирования, так что файл не перечитывается и не декодируется повторно.
+    """
+    with Image.open(path_in) as im:
+        im = ImageOps.exif_transpose(im).convert('RGB')
+        buf = BytesIO()
+        im.save(buf, format='JPEG', quality=92, subsampling=1, optimize=True)
+        info = {'phash': phash(im), 'width': im.width, 'height': im.height}
+    data = buf.getvalue()
+    ensure_dir(os.path.dirname(path_out))
+    with open(path_out, 'wb') as f:
+        f.write(data)
+    info['sha256'] = hashlib.sha256(data).hexdigest()
+    return info
+
+
 def save_preview(image: Image.Image, path_out: str):
     ensure_dir(os.path.dirname(path_out))
     image.convert('RGB').save(path_out, format='JPEG', quality=85, subsampling=1, optimize=True)
@@ -0,0 +1,61 @@
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+# Постоянное хранилище отпечатков фото пользователя (между задачами):
+# (user_id, sha256 сырых байт) -> pHash, размеры, нормализованный файл
+
+
+class FingerprintStore:
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._db.execute('PRAGMA journal_mode = WAL')
+            self._db.execute('PRAGMA synchronous = NORMAL')
+            self._db.execute('''CREATE TABLE IF NOT EXISTS fingerprints (
+                user_id INTEGER NOT NULL,
+                raw_sha256 TEXT NOT NULL,
+                sha256 TEXT NOT NULL,
+                phash TEXT NOT NULL,
+                width INTEGER NOT NULL,
+                height INTEGER NOT NULL,
+                norm_path TEXT NOT NULL,
+                job_id TEXT NOT NULL,
+                created_at INTEGER NOT NULL,
+                seen_at INTEGER NOT NULL,
+                PRIMARY KEY (user_id, raw_sha256)
+            )''')
+            self._db.commit()
+
+    def lookup(self, user_id: int, raw_sha256: str) -> Optional[dict]:
+        with self._lock:
+            row = self._db.execute(
+                'SELECT sha256, phash, width, height, norm_path, job_id FROM fingerprints WHERE user_id = ? AND raw_sha256 = ?',
+                (user_id, raw_sha256)
+            ).fetchone()
+        if row is None:
+            return None
+        sha, ph, w, h, norm_path, job_id = row
+        # pHash — 64-bit без знака, в SQLite храним hex-строкой
+        return {'sha256': sha, 'phash': int(ph, 16), 'width': w, 'height': h, 'norm_path': norm_path, 'job_id': job_id}
+
+    def record(self, user_id: int, raw_sha256: str, *, sha256: str, phash: int, width: int, height: int, norm_path: str, job_id: str):
+        now = int(time.time())
+        with self._lock:
+            self._db.execute(
+                '''INSERT INTO fingerprints (user_id, raw_sha256, sha256, phash, width, height, norm_path, job_id, created_at, seen_at)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                   ON CONFLICT (user_id, raw_sha256) DO UPDATE SET
+                     sha256 = excluded.sha256, phash = excluded.phash, width = excluded.width, height = excluded.height,
+                     norm_path = excluded.norm_path, job_id = excluded.job_id, seen_at = excluded.seen_at''',
+                (user_id, raw_sha256, sha256, f'{int(phash):016x}', width, height, norm_path, job_id, now, now)
+            )
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,35 @@
+from collections import OrderedDict
+import numpy as np
+from PIL import Image, ImageOps
+
+# LRU-кэш декодированных исходников (RGB ndarray) с лимитом по байтам
+
+
+class FrameCache:
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._frames: 'OrderedDict[str, np.ndarray]' = OrderedDict()
+
+    def get(self, path: str) -> np.ndarray:
+        arr = self._frames.get(path)
+        if arr is not None:
+            self._frames.move_to_end(path)
+            return arr
+        with Image.open(path) as im:
+            arr = np.asarray(ImageOps.exif_transpose(im).convert('RGB'))
+        arr.flags.writeable = False
+        self._frames[path] = arr
+        self.bytes += arr.nbytes
+        # самый свежий кадр держим всегда, даже если он один больше лимита
+        while self.bytes > self.max_bytes and len(self._frames) > 1:
+            _, old = self._frames.popitem(last=False)
+            self.bytes -= old.nbytes
+        return arr
+
+    def image(self, path: str) -> Image.Image:
+        return Image.fromarray(self.get(path))
+
+    def clear(self):
+        self._frames.clear()
+        self.bytes = 0
@@ -1,12 +1,54 @@
+from typing import Iterable
 from PIL import Image
 import numpy as np
 
 # Перцептуальный хэш (pHash) 64-bit
 
-def phash(image: Image.Image) -> int:
+
+def _dct_matrix(n: int) -> np.ndarray:
+    # ортонормированная DCT-II: X = D @ x
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    d = np.cos(np.pi * (2 * i + 1) * k / (2 * n)) * np.sqrt(2.0 / n)
+    d[0] /= np.sqrt(2.0)
+    return d
+
+
+# Нужны только 8 низших частот из 32 — берём сразу 8 строк матрицы
+_DCT8 = _dct_matrix(32)[:8].astype(np.float64)
+
+
+def _tile(image: Image.Image) -> np.ndarray:
+    return np.asarray(image.convert('L').resize((32, 32), Image.Resampling.LANCZOS), dtype=np.float64)
+
+
+def _hash_tiles(tiles: np.ndarray) -> np.ndarray:
+    # tiles: (n, 32, 32) -> (n,) uint64
+    dct = _DCT8 @ tiles @ _DCT8.T
+    flat = dct.reshape(len(tiles), 64)
+    med = np.median(flat, axis=1, keepdims=True)
+    packed = np.packbits(flat > med, axis=1)
+    return packed.view('>u8').astype(np.uint64).ravel()
+
+
+def phash(image: Image.Image, legacy: bool = False) -> int:
+    if legacy:
+        return phash_legacy(image)
+    return int(_hash_tiles(_tile(image)[None])[0])
+
+
+def phash_many(images: Iterable[Image.Image]) -> np.ndarray:
+    """pHash для пачки изображений одной матричной операцией; возвращает массив uint64."""
+    tiles = [_tile(im) for im in images]
+    if not tiles:
+        return np.zeros(0, dtype=np.uint64)
+    return _hash_tiles(np.stack(tiles))
+
+
+def phash_legacy(image: Image.Image) -> int:
+    # Прежний вариант (вещественная часть FFT вместо DCT) — для сравнения со старыми job.json
     img = image.convert('L').resize((32, 32), Image.Resampling.LANCZOS)
     pixels = np.asarray(img, dtype=np.float32)
-    # DCT по строкам, затем по столбцам
     dct1 = np.real(np.fft.fft(pixels, axis=0))
     dct2 = np.real(np.fft.fft(dct1, axis=1))
     dct = dct2[:8, :8]
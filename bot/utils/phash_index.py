@@ -0,0 +1,95 @@
+from typing import Dict, Hashable, List, Optional, Tuple
+
+from utils.phash import hamming
+
+# BK-дерево по 64-bit pHash: вставка, поиск в радиусе и удаление без полного пересчёта
+
+
+class _Node:
+    __slots__ = ('phash', 'keys', 'children')
+
+    def __init__(self, phash: int):
+        self.phash = phash
+        self.keys: List[Hashable] = []
+        self.children: Dict[int, '_Node'] = {}
+
+
+class PhashIndex:
+    def __init__(self):
+        self._root: Optional[_Node] = None
+        self._nodes: Dict[Hashable, _Node] = {}
+        self._dead = 0  # узлы без ключей (после remove) — остаются для маршрутизации
+
+    def __len__(self) -> int:
+        return len(self._nodes)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._nodes
+
+    def add(self, phash: int, key: Hashable):
+        phash = int(phash)
+        if key in self._nodes:
+            self.remove(key)
+        created = False
+        if self._root is None:
+            self._root = node = _Node(phash)
+            created = True
+        else:
+            node = self._root
+            while True:
+                d = hamming(phash, node.phash)
+                if d == 0:
+                    break
+                child = node.children.get(d)
+                if child is None:
+                    node.children[d] = node = _Node(phash)
+                    created = True
+                    break
+                node = child
+        if not created and not node.keys:
+            self._dead -= 1  # ожил пустой узел
+        node.keys.append(key)
+        self._nodes[key] = node
+
+    def query(self, phash: int, radius: int) -> List[Tuple[Hashable, int]]:
+        """Все ключи с расстоянием Хэмминга <= radius, по возрастанию расстояния."""
+        phash = int(phash)
+        out = []
+        stack = [self._root] if self._root is not None else []
+        while stack:
+            node = stack.pop()
+            d = hamming(phash, node.phash)
+            if d <= radius:
+                out.extend((k, d) for k in node.keys)
+            for cd, child in node.children.items():
+                if d - radius <= cd <= d + radius:
+                    stack.append(child)
+        out.sort(key=lambda x: x[1])
+        return out
+
+    def nearest(self, phash: int, radius: int) -> Optional[Tuple[Hashable, int]]:
+        found = self.query(phash, radius)
+        return found[0] if found else None
+
+    def remove(self, key: Hashable) -> bool:
+        node = self._nodes.pop(key, None)
+        if node is None:
+            return False
+        node.keys.remove(key)
+        if not node.keys:
+            self._dead += 1
+            # слишком много пустых узлов — перестраиваем дерево
+            if self._dead > len(self._nodes):
+                self._rebuild()
+        return True
+
+    def clear(self):
+        self._root = None
+        self._nodes.clear()
+        self._dead = 0
+
+    def _rebuild(self):
+        items = [(node.phash, key) for key, node in self._nodes.items()]
+        self.clear()
+        for phash, key in items:
+            self.add(phash, key)
@@ -0,0 +1,129 @@
+import hashlib
+from typing import Callable, Dict, FrozenSet, List, Optional, Tuple
+
+import numpy as np
+
+# Уникальность текстов: шинглы слов -> MinHash -> LSH-бакеты для кандидатов,
+# решение по точному Жаккару только для кандидатов (без попарного перебора всех текстов)
+
+_PRIME = np.uint64((1 << 32) - 5)
+
+
+def shingles(text: str, k: int = 1) -> FrozenSet[str]:
+    # k=1 — множество слов, как в прежнем simple_text_difference
+    words = text.lower().split()
+    if k <= 1 or len(words) <= k:
+        return frozenset(words) if k <= 1 else frozenset([' '.join(words)] if words else [])
+    return frozenset(' '.join(words[i:i + k]) for i in range(len(words) - k + 1))
+
+
+def jaccard(a: FrozenSet[str], b: FrozenSet[str]) -> float:
+    if not a and not b:
+        return 1.0
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def _pick_bands(num_perm: int, threshold: float, recall: float = 0.999) -> Tuple[int, int]:
+    # самые узкие бакеты (больше r), при которых пара с Жаккаром = threshold почти наверняка станет кандидатом
+    best = (num_perm, 1)
+    for r in range(1, num_perm + 1):
+        if num_perm % r:
+            continue
+        b = num_perm // r
+        if 1 - (1 - threshold ** r) ** b >= recall:
+            best = (b, r)
+    return best
+
+
+class UniquenessIndex:
+    """Индекс текстов для проверки «достаточно ли отличается».
+
+    Текст считается дубликатом, если его Жаккар по шинглам с каким-то уже
+    добавленным текстом больше 1 - min_difference (то же правило, что у
+    прежнего ensure_unique_texts при shingle=1).
+    """
+
+    def __init__(self, min_difference: float = 0.3, shingle: int = 1, num_perm: int = 128, seed: int = 1):
+        self.min_difference = min_difference
+        self.shingle = shingle
+        self.num_perm = num_perm
+        rng = np.random.default_rng(seed)
+        self._a = rng.integers(1, int(_PRIME), size=num_perm, dtype=np.uint64)
+        self._b = rng.integers(0, int(_PRIME), size=num_perm, dtype=np.uint64)
+        self.bands, self.rows = _pick_bands(num_perm, max(0.0, 1.0 - min_difference))
+        self._buckets: List[Dict[bytes, List[int]]] = [{} for _ in range(self.bands)]
+        self._sets: List[FrozenSet[str]] = []
+        self._empty: List[int] = []
+
+    def __len__(self) -> int:
+        return len(self._sets)
+
+    def _signature(self, sh: FrozenSet[str]) -> np.ndarray:
+        hv = np.fromiter((int.from_bytes(hashlib.blake2b(s.encode('utf-8'), digest_size=4).digest(), 'little') for s in sh),
+                         dtype=np.uint64, count=len(sh))
+        # (a·x + b) mod p для всех перестановок сразу; минимум по шинглам
+        return ((hv[:, None] * self._a[None, :] + self._b[None, :]) % _PRIME).min(axis=0)
+
+    def _bands_of(self, sig: np.ndarray):
+        for i in range(self.bands):
+            yield i, sig[i * self.rows:(i + 1) * self.rows].tobytes()
+
+    def _candidates(self, sh: FrozenSet[str], sig: Optional[np.ndarray]) -> List[int]:
+        if sig is None:
+            return list(self._empty)
+        found = set()
+        for i, key in self._bands_of(sig):
+            found.update(self._buckets[i].get(key, ()))
+        return sorted(found)
+
+    def nearest(self, text: str) -> Optional[Tuple[int, float]]:
+        """Ближайший добавленный текст среди кандидатов LSH: (индекс, Жаккар) или None."""
+        sh = shingles(text, self.shingle)
+        sig = self._signature(sh) if sh else None
+        best = None
+        for idx in self._candidates(sh, sig):
+            j = jaccard(sh, self._sets[idx])
+            if best is None or j > best[1]:
+                best = (idx, j)
+        return best
+
+    def is_unique(self, text: str) -> bool:
+        near = self.nearest(text)
+        return near is None or 1.0 - near[1] >= self.min_difference
+
+    def add(self, text: str) -> int:
+        sh = shingles(text, self.shingle)
+        idx = len(self._sets)
+        self._sets.append(sh)
+        if not sh:
+            self._empty.append(idx)
+            return idx
+        for i, key in self._bands_of(self._signature(sh)):
+            self._buckets[i].setdefault(key, []).append(idx)
+        return idx
+
+
+class UniqueTexts:
+    """Жадный отбор по мере поступления: уникальный текст берётся как есть,
+    неуникальный (или пустой) — с пометкой mark(text, i). Результат для i-го
+    текста зависит только от предыдущих, поэтому тексты можно подавать чанками.
+    """
+
+    def __init__(self, min_difference: float = 0.3, shingle: int = 1,
+                 mark: Callable[[str, int], str] = lambda text, i: f"{text} [Объявление №{i+1}]"):
+        self.index = UniquenessIndex(min_difference, shingle)
+        self.mark = mark
+        self.texts: List[str] = []
+        self._seen = set()
+
+    def add(self, text: str) -> str:
+        i = len(self.texts)
+        clean = text.strip()
+        if not clean or clean in self._seen or not self.index.is_unique(clean):
+            clean = self.mark(clean, i)
+        self.index.add(clean)
+        self._seen.add(clean)
+        self.texts.append(clean)
+        return clean
@@ -1,4 +1,4 @@
-import { sqliteTable, text, integer } from 'drizzle-orm/sqlite-core';
+import { sqliteTable, text, integer, primaryKey } from 'drizzle-orm/sqlite-core';
 
 export const users = sqliteTable('users', {
   id: text('id').primaryKey(),
@@ -15,3 +15,13 @@ export const watermarks = sqliteTable('watermarks', {
   margin: integer('margin').notNull(),
   updatedAt: integer('updatedAt').notNull()
 });
+
+// Кэш сгенерированных вариантов: key — канонический хэш фактов, описания и стиля, idx — порядок в пуле
+export const textCache = sqliteTable('text_cache', {
+  key: text('key').notNull(),
+  idx: integer('idx').notNull(),
+  text: text('text').notNull(),
+  createdAt: integer('createdAt').notNull()
+}, (t) => ({
+  pk: primaryKey({ columns: [t.key, t.idx] })
+}));
@@ -11,6 +11,7 @@ import { users, watermarks } from './db/schema.js';
 import watermarkRouter from './routes/watermark.js';
 import textsRouter from './routes/texts.js';
 import zipRouter from './routes/zip.js';
+import downloadRouter from './routes/download.js';
 
 // Инициализация dotenv
 const __filename = fileURLToPath(import.meta.url);
@@ -55,6 +56,13 @@ async function runMigrations(raw) {
     margin integer NOT NULL,
     updatedAt integer NOT NULL
   );`);
+  raw.exec(`CREATE TABLE IF NOT EXISTS text_cache (
+    key text NOT NULL,
+    idx integer NOT NULL,
+    text text NOT NULL,
+    createdAt integer NOT NULL,
+    PRIMARY KEY (key, idx)
+  );`);
 }
 
 async function main() {
@@ -70,6 +78,7 @@ async function main() {
   app.use(watermarkRouter);
   app.use(textsRouter);
   app.use(zipRouter);
+  app.use(downloadRouter);
 
   app.get('/health', (req, res) => res.json({ ok: true }));
 
@@ -0,0 +1,41 @@
+import { Router } from 'express';
+import crypto from 'crypto';
+import path from 'path';
+
+const router = Router();
+
+// Архивы лежат в рабочей папке бота; ссылка: /download/<путь от корня>?exp=<unix>&sig=<hmac>
+const DOWNLOAD_ROOT = () => path.resolve(process.env.DOWNLOAD_ROOT || './bot/workspace');
+
+// Та же подпись, что у бота (bot/links.py): HMAC-SHA256 от "<путь>\n<exp>"
+export function signDownload(relPath, exp, secret = process.env.DOWNLOAD_SECRET) {
+  return crypto.createHmac('sha256', secret).update(`${relPath}\n${exp}`).digest('hex');
+}
+
+function validSignature(relPath, exp, sig) {
+  const expected = Buffer.from(signDownload(relPath, exp), 'hex');
+  const given = Buffer.from(String(sig || ''), 'hex');
+  return given.length === expected.length && crypto.timingSafeEqual(given, expected);
+}
+
+router.get('/download/*', (req, res) => {
+  if (!process.env.DOWNLOAD_SECRET) return res.status(404).end();
+  const relPath = req.params[0];
+  const exp = Number(req.query.exp);
+  if (!relPath || !Number.isFinite(exp) || !validSignature(relPath, exp, req.query.sig)) {
+    return res.status(403).json({ error: 'Invalid link' });
+  }
+  if (exp < Date.now() / 1000) return res.status(410).json({ error: 'Link expired' });
+
+  const root = DOWNLOAD_ROOT();
+  const filePath = path.resolve(root, relPath);
+  if (!filePath.startsWith(root + path.sep)) return res.status(403).json({ error: 'Invalid link' });
+
+  // sendFile стримит с диска и сам отвечает на Range/If-Range (206), отдаёт ETag и Last-Modified,
+  // поэтому прерванную загрузку можно докачать
+  res.download(filePath, path.basename(filePath), { acceptRanges: true, dotfiles: 'deny' }, (err) => {
+    if (err && !res.headersSent) res.status(err.status || 404).json({ error: 'Not found' });
+  });
+});
+
+export default router;
@@ -1,6 +1,7 @@
 import { Router } from 'express';
 import { z } from 'zod';
-import { generateTexts, getLLMInfo, getLastLLMTrace, testLLM } from '../services/textGen.js';
+import { getLLMInfo, getLastLLMTrace, testLLM } from '../services/textGen.js';
+import { generateTextsCached } from '../services/textCache.js';
 
 const router = Router();
 
@@ -9,35 +10,50 @@ const Body = z.object({
   baseDescription: z.string().min(1),
   n: z.number().min(1).max(100),
   styleHints: z.string().optional(),
-  debug: z.boolean().optional()
+  debug: z.boolean().optional(),
+  stream: z.boolean().optional()
 });
 
+// NDJSON: по строке {"variants":[...]} на каждый готовый чанк, в конце {"done":true,"count":k}.
+// Fallback-тексты в поток не попадают — недостающие варианты клиент добивает сам.
+async function streamVariants(req, res, params) {
+  res.status(200);
+  res.setHeader('Content-Type', 'application/x-ndjson; charset=utf-8');
+  res.setHeader('Cache-Control', 'no-cache');
+  res.flushHeaders();
+  let count = 0;
+  try {
+    // варианты уже дедуплицированы в generateTexts (services/uniq.js)
+    await generateTextsCached({
+      ...params,
+      onVariants: async (fresh) => {
+        if (!fresh.length || res.writableEnded) return;
+        count += fresh.length;
+        res.write(JSON.stringify({ variants: fresh }) + '\n');
+      }
+    });
+  } catch (e) {
+    console.error('texts/generate stream error:', e);
+  }
+  if (!res.writableEnded) res.end(JSON.stringify({ done: true, count }) + '\n');
+}
+
 router.post('/texts/generate', async (req, res) => {
   try {
     const parse = Body.safeParse(req.body);
     if (!parse.success) {
       return res.status(200).json({ ok: true, variants: [] });
     }
-    const { baseFacts, baseDescription, n, styleHints, debug } = parse.data;
-    let variants = await generateTexts({ baseFacts, baseDescription, n, styleHints, debug: Boolean(debug) });
-
-    // Лёгкая дедупликация (страховка): нормализация + точное сравнение
-    const norm = (s) => String(s || '')
-      .toLowerCase()
-      .replace(/[^\p{L}\p{N}\s]+/gu, ' ')
-      .replace(/\s+/g, ' ')
-      .trim();
-    const out = [];
-    for (const t of Array.isArray(variants) ? variants : []) {
-      if (!t || typeof t !== 'string') continue;
-      const k = norm(t);
-      if (!k) continue;
-      if (!out.some((x) => norm(x) === k)) out.push(t.trim());
+    const { baseFacts, baseDescription, n, styleHints, debug, stream } = parse.data;
+    if (stream) {
+      return await streamVariants(req, res, { baseFacts, baseDescription, n, styleHints, debug: Boolean(debug) });
     }
-    if (out.length > 0) variants = out.slice(0, n || out.length);
+    // варианты уже дедуплицированы в generateTexts (services/uniq.js)
+    const variants = await generateTextsCached({ baseFacts, baseDescription, n, styleHints, debug: Boolean(debug) });
     return res.status(200).json({ ok: true, variants: Array.isArray(variants) ? variants : [] });
   } catch (e) {
     console.error('texts/generate fatal:', e);
+    if (res.headersSent) return res.end();
     return res.status(200).json({ ok: true, variants: [] });
   }
 });
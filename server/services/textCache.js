@@ -0,0 +1,135 @@
+import crypto from 'crypto';
+import path from 'path';
+import Database from 'better-sqlite3';
+import { drizzle } from 'drizzle-orm/better-sqlite3';
+import { eq, asc } from 'drizzle-orm';
+import { textCache } from '../db/schema.js';
+import { generateTexts } from './textGen.js';
+
+// Кэш вариантов текста по каноническому ключу (факты + описание + стиль).
+// Повтор задачи и повторная публикация того же объекта берут тексты из пула,
+// при большем N пул добирается, одинаковые одновременные запросы идут одним полётом.
+
+let db = null;
+function getDb() {
+  if (!db) {
+    const raw = new Database(path.resolve('./data/db.sqlite'));
+    raw.pragma('journal_mode = WAL');
+    db = drizzle(raw);
+  }
+  return db;
+}
+
+const enabled = () => process.env.TEXT_CACHE !== '0';
+
+const norm = (s) => String(s || '').replace(/\s+/g, ' ').trim();
+
+// JSON с отсортированными ключами: порядок полей в запросе не меняет ключ
+function canonical(v) {
+  if (Array.isArray(v)) return `[${v.map(canonical).join(',')}]`;
+  if (v && typeof v === 'object') {
+    return `{${Object.keys(v).sort().map((k) => `${JSON.stringify(k)}:${canonical(v[k])}`).join(',')}}`;
+  }
+  return JSON.stringify(typeof v === 'string' ? norm(v) : v ?? null);
+}
+
+export function cacheKey({ baseFacts, baseDescription, styleHints }) {
+  const payload = canonical({
+    facts: baseFacts?.structured ?? null,
+    source: baseFacts?.source ?? null,
+    description: baseDescription,
+    style: styleHints ?? null
+  });
+  return crypto.createHash('sha256').update(payload).digest('hex');
+}
+
+function readPool(key) {
+  return getDb().select({ text: textCache.text }).from(textCache)
+    .where(eq(textCache.key, key)).orderBy(asc(textCache.idx)).all()
+    .map((r) => r.text);
+}
+
+function appendPool(key, start, texts) {
+  const now = Date.now();
+  getDb().insert(textCache)
+    .values(texts.map((t, i) => ({ key, idx: start + i, text: t, createdAt: now })))
+    .onConflictDoNothing()
+    .run();
+}
+
+// Полёты генерации по ключу: { listeners, added, done }
+const inflight = new Map();
+
+function startFlight(key, params, need, existing) {
+  const flight = { listeners: new Set(), added: 0, done: null };
+  let next = existing.length;
+  flight.done = generateTexts({
+    ...params,
+    n: need,
+    existing,
+    onVariants: async (fresh) => {
+      // в пул пишем сразу: оборванный полёт не теряет уже полученное
+      appendPool(key, next, fresh);
+      next += fresh.length;
+      flight.added += fresh.length;
+      for (const l of flight.listeners) l(fresh);
+    }
+  }).catch((e) => {
+    console.error('text cache flight error:', e);
+  }).finally(() => {
+    inflight.delete(key);
+  });
+  inflight.set(key, flight);
+  return flight;
+}
+
+// Как generateTexts, но через кэш. onVariants получает варианты в порядке пула.
+export async function generateTextsCached({ baseFacts, baseDescription, n, styleHints, onVariants, ...rest }) {
+  if (!enabled()) return generateTexts({ baseFacts, baseDescription, n, styleHints, onVariants, ...rest });
+
+  const key = cacheKey({ baseFacts, baseDescription, styleHints });
+  const out = [];
+  let chain = Promise.resolve();
+  const emit = (list) => {
+    const take = list.slice(0, n - out.length);
+    if (!take.length) return chain;
+    out.push(...take);
+    if (onVariants) chain = chain.then(() => onVariants(take));
+    return chain;
+  };
+
+  while (out.length < n) {
+    // чтение пула и подписка на полёт — синхронно, чтобы не пропустить варианты между ними
+    const pool = readPool(key);
+    let flight = inflight.get(key);
+    const own = !flight;
+    emit(pool.slice(out.length));
+    if (out.length >= n) break;
+    if (own) {
+      // добираем только недостающее, новые варианты должны отличаться от уже лежащих в пуле
+      flight = startFlight(key, { baseFacts, baseDescription, styleHints, ...rest }, n - pool.length, pool);
+    }
+    let listener;
+    const enough = new Promise((resolve) => {
+      listener = (fresh) => {
+        emit(fresh);
+        if (out.length >= n) resolve();
+      };
+    });
+    flight.listeners.add(listener);
+    const before = flight.added;
+    await Promise.race([flight.done, enough]);
+    flight.listeners.delete(listener);
+    // наш полёт закончился, ничего не добавив (LLM недоступна) — дальше не крутимся;
+    // чужой полёт мог быть рассчитан на меньшее N — тогда следующий круг запустит свой
+    if (own && out.length < n && flight.added === before) break;
+  }
+  await chain;
+
+  // Если не удалось — fallback (в кэш не попадает)
+  const result = out.slice();
+  while (result.length < n) {
+    result.push(`${baseDescription}\n\n[Вариант ${result.length + 1} • ${Math.random().toString(16).slice(2, 8)}]`);
+  }
+  return result.slice(0, n);
+}
@@ -1,41 +1,37 @@
 import Groq from 'groq-sdk';
+import { UniquenessIndex } from './uniq.js';
 
-// --- Простая дедупликация ---
-function normalize(s) {
-  return String(s || '')
-    .toLowerCase()
-    .replace(/[^\p{L}\p{N}\s]+/gu, ' ')
-    .replace(/\s+/g, ' ')
-    .trim();
-}
-function isUnique(arr, s, minDiff = 3) {
-  const normS = normalize(s);
-  for (const t of arr) {
-    const normT = normalize(t);
-    if (normT === normS) return false;
-    // Словарная разница
-    const a = new Set(normT.split(' '));
-    const b = new Set(normS.split(' '));
-    let diff = 0;
-    for (const w of a) if (!b.has(w)) diff++;
-    for (const w of b) if (!a.has(w)) diff++;
-    if (diff < minDiff) return false;
+// --- Настройки генерации ---
+// Размер чанка (вариантов на один запрос к LLM), число параллельных чанков,
+// задержка до дублирующего (hedged) запроса для медленного чанка и токены на вариант
+const CHUNK_SIZE = () => Math.max(1, Number(process.env.TEXT_CHUNK_SIZE || 10));
+const CONCURRENCY = () => Math.max(1, Number(process.env.TEXT_CONCURRENCY || 4));
+const HEDGE_MS = () => Math.max(0, Number(process.env.TEXT_HEDGE_MS || 20000));
+const TOKENS_PER_VARIANT = () => Math.max(100, Number(process.env.TEXT_TOKENS_PER_VARIANT || 450));
+// Порог дедупликации на сервере — доля различающихся слов (1 - Жаккар), а не прежнее «минимум 3 разных слова»:
+// при 0.1 в тексте из ~90 слов нужно заменить хотя бы 5 слов, у коротких текстов хватает и одного
+const DEDUP_DIFFERENCE = () => Number(process.env.TEXT_DEDUP_DIFFERENCE || 0.1);
+
+// Ракурсы по чанкам: параллельные запросы не знают друг о друге, так меньше повторов между ними
+const ANGLES = ['планировка', 'свет и пространство', 'инфраструктура', 'сценарии жизни', 'инвест-логика'];
+
+// Один клиент на процесс (keep-alive соединения переиспользуются между запросами)
+let groqClient = null;
+function getClient() {
+  if (!groqClient) {
+    groqClient = new Groq({ apiKey: process.env.GROQ_API_KEY });
   }
-  return true;
+  return groqClient;
 }
 
-// --- Основная функция генерации ---
-export async function generateTexts({ baseFacts, baseDescription, n, styleHints }) {
-  const apiKey = process.env.GROQ_API_KEY;
-  const model = process.env.GROQ_MODEL || 'llama-3.3-70b-versatile';
-  const groq = new Groq({ apiKey });
-
-  console.log('GROQ_API_KEY:', !!apiKey, 'GROQ_MODEL:', model);
+function getModel() {
+  return process.env.GROQ_MODEL || 'llama-3.3-70b-versatile';
+}
 
-  // Формируем промпт для модели
-  const norm = (s) => String(s || '').replace(/\s+/g, ' ').trim();
+const norm = (s) => String(s || '').replace(/\s+/g, ' ').trim();
 
-  const facts = baseFacts?.structured
+function factsLine(baseFacts) {
+  return baseFacts?.structured
     ? Object.entries(baseFacts.structured)
         .map(([k, v]) => {
           if (Array.isArray(v)) return `${k}: ${v.map(norm).join(', ')}`;
@@ -44,8 +40,11 @@ export async function generateTexts({ baseFacts, baseDescription, n, styleHints
         })
         .join('; ')
     : norm(baseFacts?.source);
+}
 
-  const prompt = [
+// Формируем промпт для модели
+function buildPrompt({ facts, baseDescription, n, angle }) {
+  return [
     'ВАЖНО: Ответ — только валидный JSON-массив строк, без объектов, без ключей, без пояснений, без фигурных скобок {}. Пример: ["...", "..."]',
     'Не используй фигурные скобки {} вообще. Только квадратные [].',
     'Ответ начинается с [ и заканчивается на ].',
@@ -55,75 +54,157 @@ export async function generateTexts({ baseFacts, baseDescription, n, styleHints
     'Требования к каждому варианту: 580-640 символов (с пробелами); один абзац без переносов строк (\\n и \\r запрещены); без эмодзи и CAPS; орфография — норма.',
     'Запрещено: добавлять несуществующие детали; менять числа, адреса, площади, цены, сроки; писать оценочные расстояния/виды/сроки, если их нет в фактах; нумеровать варианты.',
     'Разнообразие: меняй ракурс (планировка/свет/инфраструктура/сценарии/инвест-логика), синтаксис и лексику; не повторяй целые фразы между вариантами.',
+    angle ? `Основной ракурс этой серии вариантов: ${angle}.` : '',
     'Если какого-то факта нет — просто опусти его.',
     `Перед выводом проверь: длина каждого варианта 450–580; вариантов ровно ${n}; все соответствуют фактам; формулировки существенно различаются; внутри строк нет неэкранированных " или \\.`,
     'Верни сразу валидный JSON-массив строк без пояснений.'
   ].filter(Boolean).join('\n');
+}
 
-
-  let variants = [];
-  let error = null;
-
-  for (let attempt = 0; attempt < 2; ++attempt) {
-    try {
-      const resp = await groq.chat.completions.create({
-        model,
-        messages: [
-          { role: 'user', content: prompt }
-        ],
-        temperature: 1.5,
-        top_p: 1,
-        max_completion_tokens: 10500,
-        response_format: { type: "json_object" } // <-- это и есть требование JSON
-      });
-      let raw = resp.choices?.[0]?.message?.content || '';
-      // Парсим JSON-массив из ответа
-      let arr = [];
-      try {
-        arr = JSON.parse(raw);
-        if (Array.isArray(arr)) {
-          // Всё ок, это массив
-        } else if (arr && typeof arr === 'object') {
-          // Если это объект с ключами-строками (и значениями строками), превращаем в массив значений
-          const values = Object.values(arr);
-          if (values.every(v => typeof v === 'string')) {
-            arr = values;
-          } else if (Array.isArray(arr.variants)) {
-            arr = arr.variants;
-          } else {
-            arr = [];
-          }
-        } else {
-          arr = [];
-        }
-      } catch {
+// Парсим JSON-массив из ответа
+function parseVariants(raw) {
+  let arr = [];
+  try {
+    arr = JSON.parse(raw);
+    if (Array.isArray(arr)) {
+      // Всё ок, это массив
+    } else if (arr && typeof arr === 'object') {
+      // Если это объект с ключами-строками (и значениями строками), превращаем в массив значений
+      const values = Object.values(arr);
+      if (values.every(v => typeof v === 'string')) {
+        arr = values;
+      } else if (Array.isArray(arr.variants)) {
+        arr = arr.variants;
+      } else {
         arr = [];
       }
-      // Дедупликация
-      for (const t of arr) {
-        if (typeof t === 'string' && isUnique(variants, t)) variants.push(t.trim());
-        if (variants.length >= n) break;
-      }
-      if (variants.length >= n) break;
-    } catch (e) {
-      error = e;
-      console.error('Groq error:', e); // <--- добавьте это!
-      // Если ошибка — повторим ещё раз
+    } else {
+      arr = [];
     }
+  } catch {
+    arr = [];
   }
+  return arr.filter((t) => typeof t === 'string');
+}
+
+async function requestChunk(prompt, n, signal) {
+  const resp = await getClient().chat.completions.create({
+    model: getModel(),
+    messages: [
+      { role: 'user', content: prompt }
+    ],
+    temperature: 1.5,
+    top_p: 1,
+    // лимит по размеру чанка, а не один огромный ответ на все N
+    max_completion_tokens: 200 + n * TOKENS_PER_VARIANT(),
+    response_format: { type: "json_object" } // <-- это и есть требование JSON
+  }, { signal });
+  return parseVariants(resp.choices?.[0]?.message?.content || '');
+}
+
+// Чанк с хеджированием: если ответа нет дольше HEDGE_MS, параллельно уходит дубль,
+// берём первый успешный ответ, второй запрос отменяем
+async function hedgedChunk(prompt, n) {
+  const controllers = [];
+  const attempt = () => {
+    const ctrl = new AbortController();
+    controllers.push(ctrl);
+    return requestChunk(prompt, n, ctrl.signal);
+  };
+  let timer = null;
+  try {
+    const first = attempt();
+    const hedgeMs = HEDGE_MS();
+    if (!hedgeMs) return await first;
+    const hedge = new Promise((resolve, reject) => {
+      timer = setTimeout(() => attempt().then(resolve, reject), hedgeMs);
+    });
+    return await Promise.any([first, hedge]);
+  } finally {
+    clearTimeout(timer);
+    for (const c of controllers) c.abort();
+  }
+}
+
+// Простой пул: не больше limit задач одновременно, результаты — по мере готовности
+async function runPool(items, limit, worker) {
+  let next = 0;
+  const runners = Array.from({ length: Math.min(limit, items.length) }, async () => {
+    while (next < items.length) {
+      const i = next++;
+      await worker(items[i], i);
+    }
+  });
+  await Promise.all(runners);
+}
+
+// --- Основная функция генерации ---
+// N делится на чанки по TEXT_CHUNK_SIZE, чанки идут параллельно (TEXT_CONCURRENCY).
+// onVariants(newVariants) вызывается с новыми уникальными вариантами по мере готовности чанков.
+// existing — уже имеющиеся тексты (пул кэша): новые должны от них отличаться, в ответ они не входят.
+export async function generateTexts({ baseFacts, baseDescription, n, styleHints, onVariants, existing = [] }) {
+  console.log('GROQ_API_KEY:', !!process.env.GROQ_API_KEY, 'GROQ_MODEL:', getModel());
+
+  const facts = factsLine(baseFacts);
+  const variants = [];
+  const index = new UniquenessIndex({ minDifference: DEDUP_DIFFERENCE() });
+  for (const t of existing) index.add(t);
+
+  const accept = async (arr) => {
+    // Дедупликация между чанками
+    const fresh = [];
+    for (const t of arr) {
+      if (variants.length >= n) break;
+      if (index.isUnique(t)) {
+        index.add(t);
+        variants.push(t.trim());
+        fresh.push(t.trim());
+      }
+    }
+    if (fresh.length && onVariants) await onVariants(fresh);
+  };
+
+  const runChunks = async (total, round) => {
+    const size = CHUNK_SIZE();
+    const chunks = [];
+    for (let left = total; left > 0; left -= size) chunks.push(Math.min(size, left));
+    await runPool(chunks, CONCURRENCY(), async (k, i) => {
+      const angle = ANGLES[(i + round) % ANGLES.length];
+      try {
+        await accept(await hedgedChunk(buildPrompt({ facts, baseDescription, n: k, angle }), k));
+      } catch (e) {
+        console.error('Groq error:', e?.errors?.[0] || e);
+      }
+    });
+  };
+
+  await runChunks(n, 0);
+  // Добор недостающих (неудачные чанки, дубликаты) — один повторный раунд
+  if (variants.length < n) await runChunks(n - variants.length, 1);
 
   // Если не удалось — fallback
-  while (variants.length < n) {
-    variants.push(`${baseDescription}\n\n[Вариант ${variants.length + 1} • ${Math.random().toString(16).slice(2, 8)}]`);
+  const out = variants.slice();
+  while (out.length < n) {
+    out.push(`${baseDescription}\n\n[Вариант ${out.length + 1} • ${Math.random().toString(16).slice(2, 8)}]`);
   }
-  return variants.slice(0, n);
+  return out.slice(0, n);
+}
+
+// Короткий пинг модели через тот же клиент (для /llm/test)
+export async function testLLM() {
+  const resp = await getClient().chat.completions.create({
+    model: getModel(),
+    messages: [{ role: 'user', content: 'Ответь одним словом: ok' }],
+    max_completion_tokens: 5
+  });
+  return { ok: true, model: getModel(), reply: resp.choices?.[0]?.message?.content || '' };
 }
 
 // --- Для /llm/debug и тестов ---
 export function getLLMInfo() {
   return {
     provider: 'groq',
-    model: process.env.GROQ_MODEL || 'llama-3.3-70b-versatile',
+    model: getModel(),
     baseURL: process.env.GROQ_BASE_URL,
     hasKey: !!process.env.GROQ_API_KEY
   };
@@ -0,0 +1,125 @@
+// Уникальность текстов (зеркало bot/utils/textuniq.py): шинглы слов -> MinHash -> LSH-бакеты,
+// точный Жаккар считается только для кандидатов из общих бакетов
+
+export function normalize(s) {
+  return String(s || '')
+    .toLowerCase()
+    .replace(/[^\p{L}\p{N}\s]+/gu, ' ')
+    .replace(/\s+/g, ' ')
+    .trim();
+}
+
+export function shingles(text, k = 1) {
+  const words = normalize(text).split(' ').filter(Boolean);
+  if (k <= 1) return new Set(words);
+  if (words.length <= k) return new Set(words.length ? [words.join(' ')] : []);
+  const out = new Set();
+  for (let i = 0; i + k <= words.length; i++) out.add(words.slice(i, i + k).join(' '));
+  return out;
+}
+
+export function jaccard(a, b) {
+  if (!a.size && !b.size) return 1;
+  if (!a.size || !b.size) return 0;
+  let inter = 0;
+  for (const x of a) if (b.has(x)) inter++;
+  return inter / (a.size + b.size - inter);
+}
+
+// FNV-1a по строке и финальное перемешивание murmur3 — 32-битные хэши без BigInt
+function fnv1a(s) {
+  let h = 0x811c9dc5;
+  for (let i = 0; i < s.length; i++) {
+    h ^= s.charCodeAt(i);
+    h = Math.imul(h, 0x01000193);
+  }
+  return h >>> 0;
+}
+function fmix32(h) {
+  h ^= h >>> 16;
+  h = Math.imul(h, 0x85ebca6b);
+  h ^= h >>> 13;
+  h = Math.imul(h, 0xc2b2ae35);
+  h ^= h >>> 16;
+  return h >>> 0;
+}
+
+function pickBands(numPerm, threshold, recall = 0.999) {
+  let best = [numPerm, 1];
+  for (let r = 1; r <= numPerm; r++) {
+    if (numPerm % r) continue;
+    const b = numPerm / r;
+    if (1 - Math.pow(1 - Math.pow(threshold, r), b) >= recall) best = [b, r];
+  }
+  return best;
+}
+
+// Текст — дубликат, если Жаккар по шинглам с каким-то добавленным > 1 - minDifference
+export class UniquenessIndex {
+  constructor({ minDifference = 0.1, shingle = 1, numPerm = 64, seed = 1 } = {}) {
+    this.minDifference = minDifference;
+    this.shingle = shingle;
+    this.numPerm = numPerm;
+    this.seeds = Array.from({ length: numPerm }, (_, i) => fmix32((seed * 0x9e3779b1 + i) >>> 0));
+    [this.bands, this.rows] = pickBands(numPerm, Math.max(0, 1 - minDifference));
+    this.buckets = Array.from({ length: this.bands }, () => new Map());
+    this.sets = [];
+    this.empty = [];
+  }
+
+  get size() {
+    return this.sets.length;
+  }
+
+  signature(sh) {
+    const sig = new Uint32Array(this.numPerm).fill(0xffffffff);
+    for (const s of sh) {
+      const h = fnv1a(s);
+      for (let i = 0; i < this.numPerm; i++) {
+        const v = fmix32(h ^ this.seeds[i]);
+        if (v < sig[i]) sig[i] = v;
+      }
+    }
+    return sig;
+  }
+
+  bandKeys(sig) {
+    const keys = [];
+    for (let b = 0; b < this.bands; b++) keys.push(sig.subarray(b * this.rows, (b + 1) * this.rows).join(','));
+    return keys;
+  }
+
+  candidates(sh, sig) {
+    if (!sig) return this.empty;
+    const found = new Set();
+    this.bandKeys(sig).forEach((key, b) => {
+      for (const idx of this.buckets[b].get(key) || []) found.add(idx);
+    });
+    return [...found];
+  }
+
+  isUnique(text) {
+    const sh = shingles(text, this.shingle);
+    const sig = sh.size ? this.signature(sh) : null;
+    for (const idx of this.candidates(sh, sig)) {
+      if (1 - jaccard(sh, this.sets[idx]) < this.minDifference) return false;
+    }
+    return true;
+  }
+
+  add(text) {
+    const sh = shingles(text, this.shingle);
+    const idx = this.sets.length;
+    this.sets.push(sh);
+    if (!sh.size) {
+      this.empty.push(idx);
+      return idx;
+    }
+    this.bandKeys(this.signature(sh)).forEach((key, b) => {
+      const list = this.buckets[b].get(key);
+      if (list) list.push(idx);
+      else this.buckets[b].set(key, [idx]);
+    });
+    return idx;
+  }
+}
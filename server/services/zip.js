@@ -2,13 +2,31 @@ import fs from 'fs';
 import path from 'path';
 import archiver from 'archiver';
 
+// Уже сжатые форматы кладём без повторного сжатия; решение только по расширению,
+// без чтения файла — createZipFromFolders не блокирует event loop
+const STORED_EXTS = new Set(['.jpg', '.jpeg', '.png', '.webp', '.gif', '.zip']);
+const ZIP_LEVEL = () => Math.min(9, Math.max(0, Number(process.env.ZIP_LEVEL || 6)));
+
+// true — положить запись как STORED
+export function shouldStore(filePath) {
+  return STORED_EXTS.has(path.extname(filePath).toLowerCase());
+}
+
 export async function createZipFromFolders({ inputFolders, outputZipPath, rootFolderName, flatten = false, files = [] }) {
   await fs.promises.mkdir(path.dirname(outputZipPath), { recursive: true });
+  const started = Date.now();
   return new Promise((resolve, reject) => {
     const output = fs.createWriteStream(outputZipPath);
-    const archive = archiver('zip', { zlib: { level: 9 } });
+    // ZIP64 включается сам, когда архив или запись больше 4 ГБ
+    const archive = archiver('zip', { zlib: { level: ZIP_LEVEL() } });
 
-    output.on('close', () => resolve({ bytes: archive.pointer(), output: outputZipPath }));
+    output.on('close', () => {
+      const bytes = archive.pointer();
+      const seconds = Math.max((Date.now() - started) / 1000, 0.001);
+      const mbps = bytes / 1e6 / seconds;
+      console.log(`zip ${path.basename(outputZipPath)}: ${(bytes / 1e6).toFixed(1)} MB in ${seconds.toFixed(1)} s (${mbps.toFixed(1)} MB/s)`);
+      resolve({ bytes, output: outputZipPath, seconds, mbps });
+    });
     archive.on('warning', (err) => {
       if (err.code === 'ENOENT') {
         console.warn(err);
@@ -21,13 +39,14 @@ export async function createZipFromFolders({ inputFolders, outputZipPath, rootFo
     archive.pipe(output);
 
     for (const folder of inputFolders) {
+      const withMethod = (entry) => ({ ...entry, store: shouldStore(entry.name) });
       if (flatten) {
         // Кладём содержимое папки непосредственно под rootFolderName (без добавления basename)
-        archive.directory(folder, rootFolderName || false);
+        archive.directory(folder, rootFolderName || false, withMethod);
       } else {
         const folderName = path.basename(folder);
         const destPath = rootFolderName ? path.join(rootFolderName, folderName) : folderName;
-        archive.directory(folder, destPath);
+        archive.directory(folder, destPath, withMethod);
       }
     }
 
@@ -35,7 +54,7 @@ export async function createZipFromFolders({ inputFolders, outputZipPath, rootFo
     for (const f of files) {
       if (!f?.path || !f?.name) continue;
       const arcName = rootFolderName ? path.join(rootFolderName, f.name) : f.name;
-      archive.file(f.path, { name: arcName });
+      archive.file(f.path, { name: arcName, store: shouldStore(f.path) });
     }
 
     archive.finalize();